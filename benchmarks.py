@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+
+from mypylib import *
+
+
+def get_bench_class():
+	local = MyPyClass("/tmp/mypylib_bench.py")
+	local.db.config.isWritingLogFile = False
+	return local
+#end define
+
+def timeit(func, count):
+	start = time.perf_counter()
+	for i in range(count):
+		func(i)
+	return (time.perf_counter() - start) / count
+#end define
+
+def bench_add_log(count=200000):
+	local = get_bench_class()
+	local.db.config.logLevel = INFO
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	local.console_writer.start()
+	try:
+		filtered = timeit(lambda i: local.add_log("value=%s", i, mode=DEBUG), count)
+		emitted = timeit(lambda i: local.add_log("value=%s", i, mode=INFO), count)
+	finally:
+		local.console_writer.flush()
+		sys.stdout.close()
+		sys.stdout = stdout
+	print(f"add_log filtered: {filtered * 10**9:.0f} ns/call")
+	print(f"add_log emitted:  {emitted * 10**9:.0f} ns/call")
+#end define
+
+def make_db_data(size_mb):
+	# About 200 bytes of JSON per record
+	data = Dict()
+	count = size_mb * 1000 * 1000 // 200
+	for i in range(count):
+		group = data.setdefault(f"group_{i % 1000}", Dict())
+		group[f"item_{i}"] = {"id": i, "name": f"name_{i}", "enabled": i % 2 == 0, "values": [i, i * 2, i * 3], "ratio": i / 7}
+	return Dict(data)
+#end define
+
+def bench_db_formats(sizes=(1, 10, 100)):
+	local = get_bench_class()
+	local.db.config.isLocaldbSaving = False
+	db_path = local.buffer.my_temp_dir + "bench.db"
+	for size_mb in sizes:
+		data = make_db_data(size_mb)
+		for name in local.db_serializers:
+			start = time.perf_counter()
+			local.write_file_atomic(db_path, local.serialize_db(data, name))
+			save_time = time.perf_counter() - start
+			start = time.perf_counter()
+			local.read_db_process(db_path)
+			load_time = time.perf_counter() - start
+			file_size = os.path.getsize(db_path)
+			print(f"db {size_mb:>3} MB {name:<12} save: {save_time:7.3f} s, load: {load_time:7.3f} s, file: {b2mb(file_size)} MB")
+		#end for
+	os.remove(db_path)
+#end define
+
+def touch_db_data(data, part=0.1):
+	# Read a field of every record in the first `part` of the groups
+	keys = list(data)
+	for key in keys[:int(len(keys) * part)]:
+		for item in data[key].values():
+			item.name
+#end define
+
+def bench_lazy_dict(sizes=(10, 100)):
+	for size_mb in sizes:
+		text = json.dumps(make_db_data(size_mb))
+		for cls in (Dict, LazyDict):
+			start = time.perf_counter()
+			data = cls(json.loads(text))
+			load_time = time.perf_counter() - start
+			touch_db_data(data)
+			total_time = time.perf_counter() - start
+			print(f"db {size_mb:>3} MB {cls.__name__:<8} load: {load_time:7.3f} s, load and touch 10%: {total_time:7.3f} s")
+			del data
+		#end for
+	data = LazyDict({"value": 1})
+	attr_time = timeit(lambda i: data.value, 1000000)
+	print(f"LazyDict attribute access: {attr_time * 10**9:.0f} ns")
+	data = Dict({"value": 1})
+	attr_time = timeit(lambda i: data.value, 1000000)
+	print(f"Dict attribute access: {attr_time * 10**9:.0f} ns")
+#end define
+
+def run_cpu_threads(seconds, thread_count=4):
+	# Count loop iterations of CPU bound threads with a few stack levels
+	counts = [0] * thread_count
+	stop_time = time.perf_counter() + seconds
+	def work(level, index):
+		if level > 0:
+			return work(level - 1, index)
+		while time.perf_counter() < stop_time:
+			sum(range(1000))
+			counts[index] += 1
+	threads = [threading.Thread(target=work, args=(10, i), name=f"worker_{i}") for i in range(thread_count)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return sum(counts)
+#end define
+
+def bench_profiler(hz=100, seconds=2, rounds=5):
+	# Interleaved rounds with and without the profiler, medians cancel out the noise
+	base = list()
+	profiled = list()
+	profiler = SamplingProfiler()
+	run_cpu_threads(seconds)  # warm up
+	for i in range(rounds):
+		base.append(run_cpu_threads(seconds))
+		profiler.start(hz)
+		profiled.append(run_cpu_threads(seconds))
+		profiler.stop()
+	base.sort()
+	profiled.sort()
+	slowdown = (1 - profiled[rounds // 2] / base[rounds // 2]) * 100
+	rate = profiler.stats.samples / (seconds * rounds)
+	print(f"profiler {hz} Hz: throughput loss {slowdown:.2f}%, self measured overhead {profiler.stats.overhead_percent}%, {rate:.0f} samples/s")
+#end define
+
+BENCHMARKS = {
+	"add_log": bench_add_log,
+	"db_formats": bench_db_formats,
+	"lazy_dict": bench_lazy_dict,
+	"profiler": bench_profiler,
+}
+
+if __name__ == "__main__":
+	names = sys.argv[1:] or list(BENCHMARKS)
+	for name in names:
+		BENCHMARKS[name]()
+#end if
@@ -5,26 +5,76 @@ import os
 import re
 import sys
 import time
+import io
+import math
+import heapq
+import random
 import json
+import mmap
+import array
+import fcntl
+import asyncio
 import zlib
+import pickle
+import marshal
+import gzip
+import shutil
 import signal
+import stat
+import atexit
 import base64
 import psutil
 import struct
 import socket
+import ctypes
 import hashlib
 import platform
 import threading
+import tracemalloc
 import subprocess
+import socketserver
+import http.server
+import multiprocessing
+import ctypes.util
 import datetime as date_time_library
 from urllib.request import urlopen
 from urllib.error import URLError
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
 
 INFO = "info"
 WARNING = "warning"
 ERROR = "error"
 DEBUG = "debug"
 
+# Log queue overflow policies
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+# Log rotation segment naming
+NUMBERED = "numbered"
+TIMESTAMPED = "timestamped"
+
+# Scheduler timing modes
+FIXED_RATE = "fixed_rate"
+FIXED_DELAY = "fixed_delay"
+
+# Scheduler overrun policies, when a job is due while its previous run is not finished
+SKIP = "skip"
+QUEUE = "queue"
+CONCURRENT = "concurrent"
+
+ANSI_ESCAPE_RE = re.compile(r"\033\[[0-9;]*m")
+
+# Marks a missing key in merge_three_dicts
+MISSING = object()
+
 
 class Dict(dict):
 	def __init__(self, *args, **kwargs):
@@ -34,10 +84,12 @@ class Dict(dict):
 	#end define
 
 	def _parse_dict(self, d):
-		for key, value in d.items():
-			if type(value) in [dict, Dict]:
+		# dict.items() reads lazy containers as is instead of wrapping every child
+		items = dict.items(d) if isinstance(d, dict) else d.items()
+		for key, value in items:
+			if isinstance(value, dict):
 				value = Dict(value)
-			if type(value) == list:
+			if isinstance(value, list):
 				value = self._parse_list(value)
 			self[key] = value
 	#end define
@@ -45,7 +97,7 @@ class Dict(dict):
 	def _parse_list(self, lst):
 		result = list()
 		for value in lst:
-			if type(value) in [dict, Dict]:
+			if isinstance(value, dict):
 				value = Dict(value)
 			result.append(value)
 		return result
@@ -55,9 +107,748 @@ class Dict(dict):
 		self[key] = value
 	#end define
 
+	# Called only for missing attributes, a C method avoids an extra Python frame
+	__getattr__ = dict.get
+#end class
+
+
+class LazyDict(Dict):
+	'''Dict that takes over a parsed document without copying it.
+	Nested dicts and lists are wrapped into LazyDict/LazyList on first access,
+	the wrapper replaces the raw value so the next access returns it directly.'''
+	def __init__(self, data=None):
+		if data is not None:
+			dict.update(self, data)
+	#end define
+
+	def _wrap(self, key, value):
+		value_type = type(value)
+		if value_type is dict:
+			value = LazyDict(value)
+		elif value_type is list:
+			value = LazyList(value)
+		else:
+			return value
+		dict.__setitem__(self, key, value)
+		return value
+	#end define
+
+	def __getitem__(self, key):
+		return self._wrap(key, dict.__getitem__(self, key))
+	#end define
+
+	def get(self, key, default=None):
+		value = dict.get(self, key, MISSING)
+		if value is MISSING:
+			return default
+		return self._wrap(key, value)
+	#end define
+
+	def __getattr__(self, key):
+		value = dict.get(self, key)
+		value_type = type(value)
+		if value_type is dict or value_type is list:
+			return self._wrap(key, value)
+		return value
+	#end define
+
+	def setdefault(self, key, default=None):
+		if key in self:
+			return self[key]
+		self[key] = default
+		return default
+	#end define
+
+	def pop(self, key, *args):
+		return lazy_wrap(dict.pop(self, key, *args))
+	#end define
+
+	def popitem(self):
+		key, value = dict.popitem(self)
+		return key, lazy_wrap(value)
+	#end define
+
+	def __iter__(self):
+		# Not the C iterator, so dict(d) and {**d} read values through __getitem__
+		return dict.__iter__(self)
+	#end define
+
+	def values(self):
+		for key in list(self):
+			self[key]
+		return dict.values(self)
+	#end define
+
+	def items(self):
+		for key in list(self):
+			self[key]
+		return dict.items(self)
+	#end define
+
+	def copy(self):
+		return LazyDict(dict.copy(self))
+	#end define
+#end class
+
+
+class LazyList(list):
+	'''List counterpart of LazyDict, dicts inside it are wrapped on first access'''
+	def __getitem__(self, index):
+		value = list.__getitem__(self, index)
+		if isinstance(index, slice):
+			return [lazy_wrap(item) for item in value]
+		if type(value) is dict:
+			value = LazyDict(value)
+			list.__setitem__(self, index, value)
+		return value
+	#end define
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self[index]
+	#end define
+
+	def __reversed__(self):
+		for index in range(len(self) - 1, -1, -1):
+			yield self[index]
+	#end define
+
+	def pop(self, *args):
+		return lazy_wrap(list.pop(self, *args))
+	#end define
+
+	def copy(self):
+		return LazyList(list.copy(self))
+	#end define
+
+	def __add__(self, other):
+		return LazyList(list.__add__(self, other))
+	#end define
+#end class
+
+
+def lazy_wrap(value):
+	if type(value) is dict:
+		return LazyDict(value)
+	if type(value) is list:
+		return LazyList(value)
+	return value
+#end define
+
+
+class LatencyHistogram(Dict):
+	'''Fixed size log-linear histogram of durations in seconds: every power of two
+	from about 1 us to 128 s is split into `sub_buckets` linear buckets.
+	A Dict, so it can be kept in buffer and dumped to JSON.'''
+	min_exponent = -19
+	max_exponent = 8
+	sub_buckets = 4
+
+	def __init__(self):
+		self["count"] = 0
+		self["sum"] = 0.0
+		self["max"] = 0.0
+		self["buckets"] = [0] * ((self.max_exponent - self.min_exponent) * self.sub_buckets + 1)
+	#end define
+
+	def add(self, value):
+		mantissa, exponent = math.frexp(value)
+		if value <= 0 or exponent < self.min_exponent:
+			index = 0
+		elif exponent >= self.max_exponent:
+			index = len(self["buckets"]) - 1
+		else:
+			index = (exponent - self.min_exponent) * self.sub_buckets + int((mantissa * 2 - 1) * self.sub_buckets)
+		self["buckets"][index] += 1
+		self["count"] += 1
+		self["sum"] += value
+		if value > self["max"]:
+			self["max"] = value
+	#end define
+
+	@classmethod
+	def get_upper_bound(cls, index):
+		'''Upper bound of the bucket, the last one is unbounded'''
+		if index >= (cls.max_exponent - cls.min_exponent) * cls.sub_buckets:
+			return math.inf
+		exponent = index // cls.sub_buckets + cls.min_exponent
+		sub_bucket = index % cls.sub_buckets
+		return 2.0 ** (exponent - 1) * (1 + (sub_bucket + 1) / cls.sub_buckets)
+	#end define
+#end class
+
+
+class DirtyTracker:
+	'''Generation counter and set of changed paths shared by a TrackedDict tree'''
+	def __init__(self):
+		self.generation = 0
+		self.epoch = 0
+		self.dirty_paths = set()
+		self.quiet_ident = None  # changes of this thread only count in generation
+		self.lock = threading.Lock()
+		self.condition = threading.Condition(self.lock)
+	#end define
+
+	def mark(self, path):
+		with self.lock:
+			self.generation += 1
+			if self.quiet_ident is not None and self.quiet_ident == threading.get_ident():
+				return
+			if len(self.dirty_paths) == 0:
+				self.condition.notify_all()
+			self.dirty_paths.add(path)
+	#end define
+
+	def wait_dirty(self, timeout=None):
+		'''Wait until something is marked, returns False on timeout'''
+		with self.lock:
+			return self.condition.wait_for(self.is_dirty, timeout)
+	#end define
+
+	def is_dirty(self):
+		return len(self.dirty_paths) > 0
+	#end define
+
+	def take(self):
+		'''Return the dirty paths and start a new clean cycle'''
+		with self.lock:
+			result = self.dirty_paths
+			self.dirty_paths = set()
+		return result
+	#end define
+
+	def snapshot(self, root):
+		'''Return an O(1) snapshot of the root TrackedDict.
+		Dirty paths are left to take(), changes marked since it are not lost.'''
+		with self.lock:
+			self.epoch += 1
+			return DictSnapshot(root, self, self.epoch)
+	#end define
+#end class
+
+
+# Makes the lazy replacement of a raw child atomic with the changes of tracked containers
+tracked_lock = threading.RLock()
+
+
+def is_raw_container(value):
+	'''A dict or list left unwrapped by a lazy TrackedDict/TrackedList'''
+	return isinstance(value, (dict, list)) and type(value) is not TrackedDict and type(value) is not TrackedList
+#end define
+
+
+class TrackedDict(Dict):
+	'''Dict that reports every mutation of itself and of nested dicts and lists
+	to a DirtyTracker as a path of keys, e.g. ("config", "logLevel").
+	Dicts inside lists report the path of the list.
+	With lazy=True the nested containers of `data` are kept as they are and wrapped
+	on first access, as in LazyDict. They are never changed in place, so `data`
+	may be shared with a read-only owner such as the read_db cache.'''
+	def __init__(self, data=None, tracker=None, path=(), coarse=False, lazy=False):
+		object.__setattr__(self, "_tracker", None)
+		object.__setattr__(self, "_path", path)
+		object.__setattr__(self, "_coarse", coarse)
+		object.__setattr__(self, "_cow", None)
+		object.__setattr__(self, "_cow_epoch", 0)
+		if data is not None and lazy:
+			for key, value in dict.items(data):
+				dict.__setitem__(self, key, value)
+		elif data is not None:
+			for key, value in dict.items(data):
+				dict.__setitem__(self, key, self._wrap(key, value, tracker))
+		object.__setattr__(self, "_tracker", tracker)
+	#end define
+
+	def _wrap(self, key, value, tracker, lazy=False):
+		if self._coarse:
+			path = self._path
+		else:
+			path = self._path + (key,)
+		if isinstance(value, dict):
+			value = TrackedDict(value, tracker, path, self._coarse, lazy)
+		elif isinstance(value, list):
+			value = TrackedList(value, tracker, path, lazy)
+		return value
+	#end define
+
+	def _get_child(self, key, value):
+		# Read the key again under the lock, another thread may have wrapped or removed it
+		with tracked_lock:
+			current = dict.get(self, key, MISSING)
+			if current is MISSING:
+				return self._wrap(key, value, self._tracker, lazy=True)
+			if is_raw_container(current):
+				current = self._wrap(key, current, self._tracker, lazy=True)
+				dict.__setitem__(self, key, current)
+		return current
+	#end define
+
+	def __getitem__(self, key):
+		value = dict.__getitem__(self, key)
+		if is_raw_container(value):
+			return self._get_child(key, value)
+		return value
+	#end define
+
+	def get(self, key, default=None):
+		value = dict.get(self, key, MISSING)
+		if value is MISSING:
+			return default
+		if is_raw_container(value):
+			return self._get_child(key, value)
+		return value
+	#end define
+
 	def __getattr__(self, key):
+		value = dict.get(self, key)
+		if is_raw_container(value):
+			return self._get_child(key, value)
+		return value
+	#end define
+
+	def __iter__(self):
+		# Not the C iterator, so dict(d) and {**d} read values through __getitem__
+		return dict.__iter__(self)
+	#end define
+
+	def values(self):
+		for key in list(self):
+			self.get(key)
+		return dict.values(self)
+	#end define
+
+	def items(self):
+		for key in list(self):
+			self.get(key)
+		return dict.items(self)
+	#end define
+
+	def copy(self):
+		return Dict(dict.copy(self))
+	#end define
+
+	def _save_cow(self):
+		# Keep the content as of the last snapshot before the first change after it
+		tracker = self._tracker
+		if tracker is not None and self._cow_epoch != tracker.epoch:
+			object.__setattr__(self, "_cow", dict.copy(self))
+			object.__setattr__(self, "_cow_epoch", tracker.epoch)
+	#end define
+
+	def _mark(self, key):
+		if self._tracker is None:
+			return
+		if self._coarse:
+			self._tracker.mark(self._path)
+		else:
+			self._tracker.mark(self._path + (key,))
+	#end define
+
+	def __setitem__(self, key, value):
+		value = self._wrap(key, value, self._tracker)
+		with tracked_lock:
+			self._save_cow()
+			dict.__setitem__(self, key, value)
+		self._mark(key)
+	#end define
+
+	def __setattr__(self, key, value):
+		self[key] = value
+	#end define
+
+	def __delitem__(self, key):
+		with tracked_lock:
+			self._save_cow()
+			dict.__delitem__(self, key)
+		self._mark(key)
+	#end define
+
+	def pop(self, key, *args):
+		with tracked_lock:
+			if key in self:
+				self._save_cow()
+				self._mark(key)
+			value = dict.pop(self, key, *args)
+		if is_raw_container(value):
+			return copy_value(value)
+		return value
+	#end define
+
+	def popitem(self):
+		with tracked_lock:
+			self._save_cow()
+			key, value = dict.popitem(self)
+		self._mark(key)
+		if is_raw_container(value):
+			return key, copy_value(value)
+		return key, value
+	#end define
+
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self[key] = default
 		return self.get(key)
 	#end define
+
+	def update(self, *args, **kwargs):
+		for key, value in dict(*args, **kwargs).items():
+			self[key] = value
+	#end define
+
+	def __ior__(self, other):
+		self.update(other)
+		return self
+	#end define
+
+	def clear(self):
+		with tracked_lock:
+			keys = list(self)
+			self._save_cow()
+			dict.clear(self)
+		for key in keys:
+			self._mark(key)
+	#end define
+
+	def __reduce_ex__(self, protocol):
+		# Copies and pickles are plain Dicts, the tracker and its lock stay with the db
+		return Dict, (dict.copy(self),)
+	#end define
+#end class
+
+
+class TrackedList(list):
+	'''List counterpart of TrackedDict, any change marks the path of the list'''
+	def __init__(self, data=(), tracker=None, path=(), lazy=False):
+		self._tracker = tracker
+		self._path = path
+		self._cow = None
+		self._cow_epoch = 0
+		if lazy:
+			list.__init__(self, list.__iter__(data) if isinstance(data, list) else data)
+		else:
+			list.__init__(self, [self._wrap(value) for value in data])
+	#end define
+
+	def _wrap(self, value, lazy=False):
+		if isinstance(value, dict):
+			value = TrackedDict(value, self._tracker, self._path, True, lazy)
+		elif isinstance(value, list):
+			value = TrackedList(value, self._tracker, self._path, lazy)
+		return value
+	#end define
+
+	def _get_item(self, index):
+		# Items move on inserts, so all raw items are wrapped at once
+		# and the index is read again under the lock
+		with tracked_lock:
+			for i in range(len(self)):
+				value = list.__getitem__(self, i)
+				if is_raw_container(value):
+					list.__setitem__(self, i, self._wrap(value, lazy=True))
+			return list.__getitem__(self, index)
+	#end define
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		value = list.__getitem__(self, index)
+		if is_raw_container(value):
+			return self._get_item(index)
+		return value
+	#end define
+
+	def __iter__(self):
+		index = 0
+		while True:
+			try:
+				value = self[index]
+			except IndexError:
+				return
+			yield value
+			index += 1
+	#end define
+
+	def __reversed__(self):
+		return reversed(list(self))
+	#end define
+
+	def copy(self):
+		return list(self)
+	#end define
+
+	def __add__(self, other):
+		return list(self) + list(other)
+	#end define
+
+	def __mul__(self, count):
+		return list(self) * count
+	#end define
+
+	def _save_cow(self):
+		tracker = self._tracker
+		if tracker is not None and self._cow_epoch != tracker.epoch:
+			self._cow = list.copy(self)
+			self._cow_epoch = tracker.epoch
+	#end define
+
+	def _mark(self):
+		if self._tracker is not None:
+			self._tracker.mark(self._path)
+	#end define
+
+	def __setitem__(self, index, value):
+		if isinstance(index, slice):
+			value = [self._wrap(item) for item in value]
+		else:
+			value = self._wrap(value)
+		with tracked_lock:
+			self._save_cow()
+			list.__setitem__(self, index, value)
+		self._mark()
+	#end define
+
+	def __delitem__(self, index):
+		with tracked_lock:
+			self._save_cow()
+			list.__delitem__(self, index)
+		self._mark()
+	#end define
+
+	def __iadd__(self, other):
+		self.extend(other)
+		return self
+	#end define
+
+	def __imul__(self, count):
+		with tracked_lock:
+			self._save_cow()
+			list.__imul__(self, count)
+		self._mark()
+		return self
+	#end define
+
+	def append(self, value):
+		value = self._wrap(value)
+		with tracked_lock:
+			self._save_cow()
+			list.append(self, value)
+		self._mark()
+	#end define
+
+	def extend(self, values):
+		values = [self._wrap(value) for value in values]
+		with tracked_lock:
+			self._save_cow()
+			list.extend(self, values)
+		self._mark()
+	#end define
+
+	def insert(self, index, value):
+		value = self._wrap(value)
+		with tracked_lock:
+			self._save_cow()
+			list.insert(self, index, value)
+		self._mark()
+	#end define
+
+	def pop(self, *args):
+		with tracked_lock:
+			self._save_cow()
+			value = list.pop(self, *args)
+		self._mark()
+		if is_raw_container(value):
+			return copy_value(value)
+		return value
+	#end define
+
+	def remove(self, value):
+		with tracked_lock:
+			self._save_cow()
+			list.remove(self, value)
+		self._mark()
+	#end define
+
+	def clear(self):
+		with tracked_lock:
+			self._save_cow()
+			list.clear(self)
+		self._mark()
+	#end define
+
+	def sort(self, *args, **kwargs):
+		with tracked_lock:
+			if len(self) > 0:
+				self._get_item(0)  # key functions get wrapped items
+			self._save_cow()
+			list.sort(self, *args, **kwargs)
+		self._mark()
+	#end define
+
+	def reverse(self):
+		with tracked_lock:
+			self._save_cow()
+			list.reverse(self)
+		self._mark()
+	#end define
+
+	def __reduce_ex__(self, protocol):
+		return list, (list(self),)
+	#end define
+#end class
+
+
+class DictSnapshot:
+	'''Copy-on-write snapshot of a TrackedDict tree taken by DirtyTracker.snapshot().
+	Nothing is copied when it is taken: every node changed afterwards keeps its
+	previous shallow content in `_cow`, unchanged branches are shared with the live tree.
+	Only the latest snapshot of a tracker is valid.'''
+	def __init__(self, root, tracker, epoch):
+		self.root = root
+		self.tracker = tracker
+		self.epoch = epoch
+	#end define
+
+	def is_valid(self):
+		return self.tracker.epoch == self.epoch
+	#end define
+
+	def resolve(self, node):
+		'''Shallow content of the node as of the snapshot, children are not resolved'''
+		if type(node) in (TrackedDict, TrackedList) and node._cow_epoch == self.epoch:
+			return node._cow
+		return node
+	#end define
+
+	def materialize(self, node):
+		'''Plain deep copy of the node as of the snapshot'''
+		node = self.resolve(node)
+		if isinstance(node, dict):
+			return {key: self.materialize(value) for key, value in dict.items(node)}
+		if isinstance(node, list):
+			return [self.materialize(value) for value in list.__iter__(node)]
+		return node
+	#end define
+
+	def to_dict(self):
+		return Dict(self.materialize(self.root))
+	#end define
+#end class
+
+
+def to_builtin(data):
+	'''Copy nested Dict/TrackedDict/TrackedList into plain dicts and lists.
+	Lazy containers are read as they are, without wrapping their children.'''
+	if isinstance(data, dict):
+		return {key: to_builtin(value) for key, value in dict.items(data)}
+	if isinstance(data, list):
+		return [to_builtin(value) for value in list.__iter__(data)]
+	return data
+#end define
+
+
+def copy_value(value):
+	if isinstance(value, dict):
+		return Dict(value)
+	if isinstance(value, list):
+		return [copy_value(item) for item in value]
+	return value
+#end define
+
+
+class DbSerializer:
+	'''Base class of db file formats. Binary formats start with the line
+	b"MPDB:<name>\\n", so the format is detected when the file is loaded.
+	Files without the header are JSON.'''
+	name = None
+	binary = True
+
+	def get_header(self):
+		return b"MPDB:" + self.name.encode("utf-8") + b"\n"
+	#end define
+
+	def dumps(self, data):
+		raise NotImplementedError()
+	#end define
+
+	def loads(self, data):
+		raise NotImplementedError()
+	#end define
+#end class
+
+
+class JsonSerializer(DbSerializer):
+	name = "json"
+	binary = False
+
+	def dumps(self, data):
+		return json.dumps(data, indent=4).encode("utf-8")
+	#end define
+
+	def loads(self, data):
+		return json.loads(data)
+	#end define
+#end class
+
+
+class CompactJsonSerializer(JsonSerializer):
+	name = "json_compact"
+
+	def dumps(self, data):
+		return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode("utf-8")
+	#end define
+#end class
+
+
+class MarshalSerializer(DbSerializer):
+	name = "marshal"
+
+	def dumps(self, data):
+		return marshal.dumps(to_builtin(data))
+	#end define
+
+	def loads(self, data):
+		return marshal.loads(data)
+	#end define
+#end class
+
+
+class BuiltinPickler(pickle.Pickler):
+	'''Pickles Dict and tracked containers as plain dicts and lists'''
+	def reducer_override(self, obj):
+		if isinstance(obj, dict) and type(obj) is not dict:
+			return dict, (), None, None, iter(dict.items(obj))
+		if isinstance(obj, list) and type(obj) is not list:
+			return list, (), None, list.__iter__(obj)
+		return NotImplemented
+	#end define
+#end class
+
+
+class PickleSerializer(DbSerializer):
+	name = "pickle"
+
+	def dumps(self, data):
+		file = io.BytesIO()
+		BuiltinPickler(file, protocol=5).dump(data)
+		return file.getvalue()
+	#end define
+
+	def loads(self, data):
+		return pickle.loads(data)
+	#end define
+#end class
+
+
+class MsgpackSerializer(DbSerializer):
+	name = "msgpack"
+
+	def dumps(self, data):
+		return msgpack.packb(data, use_bin_type=True)
+	#end define
+
+	def loads(self, data):
+		return msgpack.unpackb(data, raw=False, strict_map_key=False)
+	#end define
 #end class
 
 
@@ -128,36 +919,1495 @@ class bcolors:
 		return text
 	#end define
 
-	def underline_text(*args):
-		text = bcolors.get_args(*args)
-		text = bcolors.underline + text + bcolors.endc
-		return text
+	def underline_text(*args):
+		text = bcolors.get_args(*args)
+		text = bcolors.underline + text + bcolors.endc
+		return text
+	#end define
+
+	colors = {"red": red, "green": green, "yellow": yellow, "blue": blue, "magenta": magenta, "cyan": cyan,
+			  "endc": endc, "bold": bold, "underline": underline}
+#end class
+
+
+class LogQueue:
+	'''Bounded FIFO of log lines with O(1) append and batch draining.
+	BLOCK only waits while a consumer is set with is_consumed, otherwise it drops the oldest line.'''
+	def __init__(self, maxsize=65536, overflow=BLOCK, timeout=1):
+		self.queue = deque()
+		self.cond = threading.Condition(threading.Lock())
+		self.maxsize = maxsize
+		self.overflow = overflow
+		self.timeout = timeout
+		self.flush_lines = maxsize
+		self.is_flush_requested = False
+		self.is_consumed = False  # set while a consumer thread drains the queue
+		self.stats = Dict()
+		self.stats.dropped_oldest = 0
+		self.stats.dropped_newest = 0
+	#end define
+
+	def configure(self, maxsize=None, overflow=None, timeout=None):
+		if overflow not in [None, BLOCK, DROP_OLDEST, DROP_NEWEST]:
+			raise Exception(f"LogQueue error: unknown overflow policy `{overflow}`")
+		with self.cond:
+			if maxsize is not None:
+				self.maxsize = max(int(maxsize), 1)
+			if overflow is not None:
+				self.overflow = overflow
+			if timeout is not None:
+				self.timeout = timeout
+			self.cond.notify_all()
+	#end define
+
+	def __len__(self):
+		return len(self.queue)
+	#end define
+
+	def append(self, item):
+		with self.cond:
+			if len(self.queue) >= self.maxsize:
+				# Without a consumer nobody frees space, BLOCK keeps the newest lines too
+				if self.overflow == DROP_OLDEST or (self.overflow == BLOCK and not self.is_consumed):
+					self.queue.popleft()
+					self.stats.dropped_oldest += 1
+				elif self.overflow == DROP_NEWEST:
+					self.stats.dropped_newest += 1
+					return False
+				elif not self.cond.wait_for(self.has_space, self.timeout):
+					# The writer is stuck, do not block the caller forever
+					self.stats.dropped_newest += 1
+					return False
+			self.queue.append(item)
+			if len(self.queue) == 1 or len(self.queue) == self.flush_lines:
+				self.cond.notify_all()
+		return True
+	#end define
+
+	def wait_batch(self, latency):
+		'''Wait while the queue is empty, then until it holds flush_lines items,
+		a flush is requested or `latency` seconds have passed'''
+		with self.cond:
+			self.cond.wait_for(self.__len__)
+			self.cond.wait_for(self.is_batch_ready, latency)
+			self.is_flush_requested = False
+	#end define
+
+	def is_batch_ready(self):
+		return self.is_flush_requested or len(self.queue) >= self.flush_lines
+	#end define
+
+	def request_flush(self):
+		with self.cond:
+			self.is_flush_requested = True
+			self.cond.notify_all()
+	#end define
+
+	def wait(self, timeout=None):
+		'''Wait until the queue is not empty'''
+		with self.cond:
+			return self.cond.wait_for(self.__len__, timeout)
+	#end define
+
+	def has_space(self):
+		return len(self.queue) < self.maxsize
+	#end define
+
+	def pop_batch(self, max_items=None):
+		with self.cond:
+			if max_items is None or max_items >= len(self.queue):
+				result = list(self.queue)
+				self.queue.clear()
+			else:
+				result = [self.queue.popleft() for i in range(max_items)]
+			self.cond.notify_all()
+		return result
+	#end define
+#end class
+
+
+class LogRotator:
+	'''Appends to a log file and rotates it by size, line count or age.
+	Size and line count are tracked incrementally, the file is never re-read.'''
+	# Suffix of a timestamped segment: time, counter of segments of the same second, .gz
+	segment_re = re.compile(r"^(\d{8}-\d{6})(?:-(\d+))?(\.gz)?$")
+
+	def __init__(self, path=None):
+		self.path = path
+		self.file = None
+		self.lock = threading.Lock()
+		self.inode = None
+		self.size = 0
+		self.lines = 0
+		self.open_time = 0
+		self.max_bytes = None
+		self.max_lines = None
+		self.interval = None
+		self.naming = NUMBERED
+		self.compress = False
+		self.backup_count = 1
+		self.stats = Dict()
+		self.stats.rotations = 0
+	#end define
+
+	def configure(self, max_bytes=None, max_lines=None, interval=None, naming=NUMBERED, compress=False, backup_count=1):
+		if naming not in [NUMBERED, TIMESTAMPED]:
+			raise Exception(f"LogRotator error: unknown naming `{naming}`")
+		self.max_bytes = max_bytes
+		self.max_lines = max_lines
+		self.interval = interval
+		self.naming = naming
+		self.compress = compress
+		self.backup_count = max(int(backup_count), 0)
+	#end define
+
+	def set_path(self, path):
+		with self.lock:
+			if path != self.path:
+				self.close()
+				self.path = path
+	#end define
+
+	def open(self):
+		self.file = open(self.path, 'ab')
+		stat = os.fstat(self.file.fileno())
+		self.inode = stat.st_ino
+		self.size = stat.st_size
+		self.lines = self.count_file_lines() if self.max_lines else 0
+		self.open_time = time.time()
+	#end define
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+	#end define
+
+	def count_file_lines(self, chunk_size=1 << 16):
+		# Only done once per opened segment, which is bounded by the rotation limits
+		result = 0
+		with open(self.path, 'rb') as file:
+			for chunk in iter(lambda: file.read(chunk_size), b''):
+				result += chunk.count(b'\n')
+		return result
+	#end define
+
+	def write(self, text):
+		data = text.encode("utf-8")
+		with self.lock:
+			if self.file is not None and self.is_replaced():
+				self.close()
+			if self.file is None:
+				self.open()
+			self.file.write(data)
+			self.file.flush()
+			self.size += len(data)
+			if self.max_lines:
+				self.lines += text.count('\n')
+			if self.need_rotate():
+				self.rotate()
+	#end define
+
+	def is_replaced(self):
+		# The file was removed or moved away by someone else (logrotate, isDeleteOldLogFile)
+		try:
+			return os.stat(self.path).st_ino != self.inode
+		except FileNotFoundError:
+			return True
+	#end define
+
+	def need_rotate(self):
+		if self.max_bytes and self.size >= self.max_bytes:
+			return True
+		if self.max_lines and self.lines >= self.max_lines:
+			return True
+		if self.interval and time.time() - self.open_time >= self.interval:
+			return True
+		return False
+	#end define
+
+	def rotate(self):
+		self.close()
+		if self.backup_count == 0:
+			os.remove(self.path)
+		elif self.naming == NUMBERED:
+			self.rotate_numbered()
+		else:
+			self.rotate_timestamped()
+		self.stats.rotations += 1
+	#end define
+
+	def rotate_numbered(self):
+		# path.1 is the newest segment, path.<backup_count> the oldest one
+		for i in range(self.backup_count, 0, -1):
+			for ext in ['', ".gz"]:
+				src = f"{self.path}.{i}{ext}"
+				if not os.path.isfile(src):
+					continue
+				if i == self.backup_count:
+					os.remove(src)
+				else:
+					os.replace(src, f"{self.path}.{i + 1}{ext}")
+		segment_path = self.path + ".1"
+		os.replace(self.path, segment_path)
+		self.compress_segment(segment_path)
+	#end define
+
+	def rotate_timestamped(self):
+		time_text = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+		segments = self.get_timestamped_segments()
+
+		# Segments of the same second get a growing counter, never a freed lower one
+		counters = [counter for segment_time, counter, name in segments if segment_time == time_text]
+		segment_path = f"{self.path}.{time_text}"
+		if len(counters) > 0:
+			segment_path += f"-{max(counters) + 1}"
+		os.replace(self.path, segment_path)
+		self.compress_segment(segment_path)
+
+		# Retention: sort by time, then by the counter, "-10" is newer than "-2"
+		segments = sorted(self.get_timestamped_segments())
+		dir_path = os.path.dirname(self.path) or '.'
+		for segment_time, counter, name in segments[:-self.backup_count]:
+			os.remove(os.path.join(dir_path, name))
+	#end define
+
+	def get_timestamped_segments(self):
+		'''[(time text, counter, file name)] of the segments of the log'''
+		dir_path = os.path.dirname(self.path) or '.'
+		prefix = os.path.basename(self.path) + '.'
+		result = list()
+		for name in os.listdir(dir_path):
+			match = self.segment_re.match(name[len(prefix):]) if name.startswith(prefix) else None
+			if match is not None:
+				result.append((match.group(1), int(match.group(2) or 0), name))
+		return result
+	#end define
+
+	def compress_segment(self, segment_path):
+		if self.compress is not True:
+			return
+		with open(segment_path, 'rb') as src, gzip.open(segment_path + ".gz", 'wb') as dst:
+			shutil.copyfileobj(src, dst)
+		os.remove(segment_path)
+	#end define
+#end class
+
+
+class ConsoleWriter:
+	'''Prints log records from its own thread with batched writes,
+	so that a slow stdout does not block the threads that log'''
+	def __init__(self, formatter):
+		self.formatter = formatter
+		self.queue = LogQueue(overflow=DROP_OLDEST)
+		self.lock = threading.Lock()
+		self.colors = "auto"
+		self.thread = None
+		self.stream = None
+		self.colored = False
+	#end define
+
+	def configure(self, maxsize=None, overflow=None, colors=None):
+		self.queue.configure(maxsize, overflow)
+		if colors is not None:
+			self.colors = colors
+			self.stream = None
+	#end define
+
+	def is_colored(self):
+		# sys.stdout can be replaced at runtime (see the -ef argument)
+		stream = sys.stdout
+		if stream is not self.stream:
+			self.stream = stream
+			if self.colors == "auto":
+				try:
+					self.colored = stream.isatty()
+				except Exception:
+					self.colored = False
+			else:
+				self.colored = self.colors is True
+		return self.colored
+	#end define
+
+	def start(self):
+		if self.thread is not None:
+			return
+		self.queue.is_consumed = True
+		self.thread = threading.Thread(target=self.run, name="console_writer", daemon=True)
+		self.thread.start()
+		atexit.register(self.flush)
+	#end define
+
+	def write(self, record):
+		if self.thread is None:
+			self.print_batch([record])
+		else:
+			self.queue.append(record)
+	#end define
+
+	def run(self):
+		while True:
+			self.queue.wait()
+			self.flush()
+	#end define
+
+	def flush(self):
+		with self.lock:
+			batch = self.queue.pop_batch()
+			if len(batch) > 0:
+				self.print_batch(batch)
+	#end define
+
+	def print_batch(self, batch):
+		colored = self.is_colored()
+		text = '\n'.join([self.formatter(record, colored) for record in batch]) + '\n'
+		try:
+			self.stream.write(text)
+			self.stream.flush()
+		except Exception:
+			pass
+	#end define
+#end class
+
+
+class JsonLogWriter:
+	'''Writes log records as JSON lines and keeps a sidecar index
+	with the byte offset of the first record of every time bucket.
+	Index lines have a fixed width, so lookups are a binary search.
+	With max_bytes the file is rotated to path.1 .. path.<backup_count>, each with its index.'''
+	index_line_size = 30
+
+	def __init__(self, path=None, bucket=60):
+		self.path = path
+		self.bucket = int(bucket)
+		self.max_bytes = None
+		self.backup_count = 1
+		self.file = None
+		self.index_file = None
+		self.offset = 0
+		self.last_bucket = None
+		self.lock = threading.Lock()
+		self.stats = Dict()
+		self.stats.rotations = 0
+	#end define
+
+	def configure(self, path=None, bucket=None):
+		with self.lock:
+			if path is not None and path != self.path:
+				self.close()
+				self.path = path
+			if bucket is not None and bucket != self.bucket:
+				self.close()
+				self.bucket = int(bucket)
+	#end define
+
+	def set_retention(self, max_bytes=None, backup_count=1):
+		with self.lock:
+			self.max_bytes = max_bytes
+			self.backup_count = max(int(backup_count), 0)
+	#end define
+
+	def get_index_path(self, path=None):
+		return (path or self.path) + ".idx"
+	#end define
+
+	def get_segment_paths(self):
+		'''Paths of the existing files from the oldest to the current one'''
+		result = [f"{self.path}.{i}" for i in range(self.backup_count, 0, -1)]
+		return [path for path in result if os.path.isfile(path)] + [self.path]
+	#end define
+
+	def open(self):
+		self.file = open(self.path, 'ab')
+		self.offset = os.fstat(self.file.fileno()).st_size
+		self.index_file = open(self.get_index_path(), 'ab')
+		index_size = os.fstat(self.index_file.fileno()).st_size
+		self.last_bucket = None
+		if index_size >= self.index_line_size:
+			with open(self.get_index_path(), 'rb') as file:
+				file.seek(index_size - index_size % self.index_line_size - self.index_line_size)
+				self.last_bucket = int(file.read(self.index_line_size).split()[0]) // self.bucket
+	#end define
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.index_file.close()
+			self.file = None
+			self.index_file = None
+	#end define
+
+	def write(self, records):
+		with self.lock:
+			if self.file is None:
+				self.open()
+			data = list()
+			index = list()
+			offset = self.offset
+			for mode, time_text, thread_name, text, timestamp, extra in records:
+				if '\033' in text:
+					text = ANSI_ESCAPE_RE.sub('', text)
+				item = {"ts": round(timestamp, 6), "level": mode, "thread": thread_name, "msg": text}
+				if extra:
+					item["extra"] = extra
+				line = (json.dumps(item, ensure_ascii=False, separators=(',', ':'), default=str) + '\n').encode("utf-8")
+				bucket = int(timestamp // self.bucket)
+				if self.last_bucket is None or bucket > self.last_bucket:
+					index.append("{0:012d} {1:016d}\n".format(bucket * self.bucket, offset))
+					self.last_bucket = bucket
+				data.append(line)
+				offset += len(line)
+			#end for
+
+			self.file.write(b''.join(data))
+			self.file.flush()
+			if len(index) > 0:
+				self.index_file.write(''.join(index).encode("utf-8"))
+				self.index_file.flush()
+			self.offset = offset
+			if self.max_bytes and self.offset >= self.max_bytes:
+				self.rotate()
+	#end define
+
+	def rotate(self):
+		# path.1 is the newest segment, path.<backup_count> the oldest one
+		self.close()
+		for i in range(self.backup_count, 0, -1):
+			src = f"{self.path}.{i}"
+			for path in [src, self.get_index_path(src)]:
+				if not os.path.isfile(path):
+					continue
+				if i == self.backup_count:
+					os.remove(path)
+				else:
+					os.replace(path, path.replace(src, f"{self.path}.{i + 1}", 1))
+		#end for
+		for path, segment_path in [(self.path, self.path + ".1"), (self.get_index_path(), self.get_index_path(self.path + ".1"))]:
+			if self.backup_count == 0:
+				os.remove(path)
+			else:
+				os.replace(path, segment_path)
+		self.stats["rotations"] += 1
+	#end define
+
+	def find_offset(self, since, path=None):
+		'''Return the offset of the bucket that contains `since`'''
+		index_path = self.get_index_path(path)
+		if since is None or not os.path.isfile(index_path):
+			return 0
+		with open(index_path, 'rb') as file:
+			count = os.fstat(file.fileno()).st_size // self.index_line_size
+			def get_entry(i):
+				file.seek(i * self.index_line_size)
+				bucket_time, offset = file.read(self.index_line_size).split()
+				return int(bucket_time), int(offset)
+			#end define
+
+			low, high = 0, count
+			while low < high:
+				middle = (low + high) // 2
+				if get_entry(middle)[0] <= since:
+					low = middle + 1
+				else:
+					high = middle
+			if low == 0:
+				return 0
+			return get_entry(low - 1)[1]
+	#end define
+
+	def query(self, since=None, until=None, level=None, thread=None):
+		if self.path is None:
+			return
+		if isinstance(level, str):
+			level = [level]
+		level_marks = None
+		if level is not None:
+			level_marks = [f'"level":"{item}"'.encode("utf-8") for item in level]
+		stop_time = None
+		if until is not None:
+			stop_time = (until // self.bucket + 1) * self.bucket
+		for path in self.get_segment_paths():
+			try:
+				file = open(path, 'rb')
+			except FileNotFoundError:
+				continue  # rotated away meanwhile
+			with file:
+				file.seek(self.find_offset(since, path))
+				for line in file:
+					if line[-1:] != b'\n':
+						break  # the writer has not finished this line yet
+					timestamp = float(line[6:line.index(b',')])
+					if stop_time is not None and timestamp >= stop_time:
+						return
+					if since is not None and timestamp < since:
+						continue
+					if until is not None and timestamp > until:
+						continue
+					# A quick filter only, "level" may also be a key of extra
+					if level_marks is not None and not any(mark in line for mark in level_marks):
+						continue
+					item = json.loads(line)
+					if level is not None and item["level"] not in level:
+						continue
+					if thread is not None and item["thread"] != thread:
+						continue
+					yield Dict(item)
+			#end with
+		#end for
+	#end define
+#end class
+
+
+class LogRateLimiter:
+	'''Lets the first `burst` messages of a key through in every `window`
+	seconds, then only one of every `sample` messages'''
+	def __init__(self, burst=10, sample=100, window=60):
+		self.burst = burst
+		self.sample = sample
+		self.window = window
+		self.counters = dict()
+		self.suppressed = dict()
+		self.stats = Dict()
+		self.stats.suppressed = 0
+	#end define
+
+	def configure(self, burst=None, sample=None, window=None):
+		if burst is not None:
+			self.burst = int(burst)
+		if sample is not None:
+			self.sample = max(int(sample), 1)
+		if window is not None:
+			self.window = window
+	#end define
+
+	def allow(self, key, now):
+		# Lock free on purpose: a lost increment under a race only skews the counters
+		counter = self.counters.get(key)
+		if counter is None or now - counter[0] >= self.window:
+			if len(self.counters) > 10000:
+				self.counters.clear()
+			self.counters[key] = [now, 1]
+			return True
+		counter[1] += 1
+		count = counter[1] - self.burst
+		if count <= 0 or count % self.sample == 0:
+			return True
+		self.suppressed[key] = self.suppressed.get(key, 0) + 1
+		self.stats["suppressed"] += 1
+		return False
+	#end define
+
+	def take_suppressed(self):
+		result = self.suppressed
+		self.suppressed = dict()
+		return result
+	#end define
+#end class
+
+
+class InotifyWatcher:
+	'''Calls `callback` from its own thread when a file is written, replaced
+	or deleted. Linux only, the directory is watched so atomic renames are seen too.'''
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_TO = 0x00000080
+	IN_DELETE = 0x00000200
+	IN_CLOEXEC = 0o2000000
+	event_struct = struct.Struct("iIII")
+
+	def __init__(self, path, callback):
+		self.path = path
+		self.callback = callback
+		self.fd = None
+		self.thread = None
+	#end define
+
+	def start(self):
+		if platform.system() != "Linux":
+			return False
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		fd = libc.inotify_init1(self.IN_CLOEXEC)
+		if fd < 0:
+			return False
+		dir_path = os.path.dirname(self.path) or '.'
+		mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_DELETE
+		if libc.inotify_add_watch(fd, dir_path.encode("utf-8"), mask) < 0:
+			os.close(fd)
+			return False
+		self.fd = fd
+		self.thread = threading.Thread(target=self.run, name="inotify_watcher", daemon=True)
+		self.thread.start()
+		return True
+	#end define
+
+	def run(self):
+		file_name = os.path.basename(self.path).encode("utf-8")
+		while True:
+			data = os.read(self.fd, 64 * 1024)
+			is_changed = False
+			offset = 0
+			while offset < len(data):
+				wd, mask, cookie, name_len = self.event_struct.unpack_from(data, offset)
+				offset += self.event_struct.size
+				name = data[offset:offset + name_len].rstrip(b'\0')
+				offset += name_len
+				if name == file_name:
+					is_changed = True
+			# One callback per burst of events
+			if is_changed:
+				self.callback()
+	#end define
+#end class
+
+
+class FileLock:
+	'''Inter-process lock on `path + ".flock"` with flock(2).
+	The kernel drops the lock when the owner dies, so a crash leaves no stale lock.
+	Reentrant within a thread, threads of one process are serialized.'''
+	def __init__(self, path):
+		self.path = path + ".flock"
+		self.rlock = threading.RLock()
+		self.fd = None
+		self.depth = 0
+		self.stats = Dict()
+		self.stats.acquired = 0
+		self.stats.contended = 0
+		self.stats.wait_time = 0.0
+		self.stats.max_wait_time = 0.0
+	#end define
+
+	def acquire(self, shared=False):
+		start = time.perf_counter()
+		self.rlock.acquire()
+		if self.depth > 0:
+			self.depth += 1
+			return
+		operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+		fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			try:
+				fcntl.flock(fd, operation | fcntl.LOCK_NB)
+			except BlockingIOError:
+				self.stats["contended"] += 1
+				fcntl.flock(fd, operation)
+		except:
+			os.close(fd)
+			self.rlock.release()
+			raise
+		self.fd = fd
+		self.depth = 1
+		wait_time = time.perf_counter() - start
+		self.stats["acquired"] += 1
+		self.stats["wait_time"] += wait_time
+		if wait_time > self.stats["max_wait_time"]:
+			self.stats["max_wait_time"] = wait_time
+	#end define
+
+	def release(self):
+		self.depth -= 1
+		if self.depth == 0:
+			fcntl.flock(self.fd, fcntl.LOCK_UN)
+			os.close(self.fd)
+			self.fd = None
+		self.rlock.release()
+	#end define
+#end class
+
+
+class SharedDbView:
+	'''Db snapshot published by one owner process through an mmap'd file.
+	The header is (magic, sequence, data length). The sequence is a seqlock:
+	it is odd while the owner writes, a reader retries if it was odd or has
+	changed while the data was copied. The version of the data is the sequence.'''
+	header = struct.Struct("<8sQQ")
+	magic = b"MPSHMDB1"
+	sequence_offset = 8
+
+	def __init__(self, path):
+		self.path = path
+		self.fd = None
+		self.mmap = None
+		self.is_owner = False
+		self.sequence = 0
+		self.version = 0
+		self.generation = None
+		self.stats = Dict()
+		self.stats.published = 0
+		self.stats.loaded = 0
+		self.stats.retries = 0
+	#end define
+
+	def check_owner(self, stat, max_mode, path):
+		if stat.st_uid != os.getuid():
+			raise Exception(f"SharedDbView error: `{path}` is not owned by uid {os.getuid()}")
+		if stat.st_mode & 0o777 & ~max_mode:
+			raise Exception(f"SharedDbView error: `{path}` has mode {oct(stat.st_mode & 0o777)}, expected at most {oct(max_mode)}")
+	#end define
+
+	def open_file(self, flags):
+		'''The path in /tmp is predictable, so symlinks are not followed and
+		the directory and the file must belong to this user and be private'''
+		dir_path, file_name = os.path.split(self.path)
+		dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+		try:
+			self.check_owner(os.fstat(dir_fd), 0o700, dir_path)
+			fd = os.open(file_name, flags | os.O_NOFOLLOW, 0o600, dir_fd=dir_fd)
+		finally:
+			os.close(dir_fd)
+		try:
+			self.check_owner(os.fstat(fd), 0o600, self.path)
+		except:
+			os.close(fd)
+			raise
+		return fd
+	#end define
+
+	def open_owner(self):
+		fd = self.open_file(os.O_RDWR | os.O_CREAT)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			os.close(fd)
+			raise Exception(f"SharedDbView error: `{self.path}` already has an owner")
+		size = os.fstat(fd).st_size
+		if size < self.header.size:
+			size = self.header.size + 64 * 1024
+			os.ftruncate(fd, size)
+		self.fd = fd
+		self.mmap = mmap.mmap(fd, size)
+		self.is_owner = True
+
+		# Continue the sequence of the previous owner, so that readers see a new version
+		magic, sequence, length = self.header.unpack_from(self.mmap)
+		if magic == self.magic:
+			self.sequence = sequence + sequence % 2
+		self.header.pack_into(self.mmap, 0, self.magic, self.sequence, 0)
+	#end define
+
+	def open_reader(self):
+		if self.mmap is not None:
+			return True
+		try:
+			fd = self.open_file(os.O_RDONLY)
+		except FileNotFoundError:
+			return False
+		try:
+			if os.fstat(fd).st_size < self.header.size:
+				return False
+			self.mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+		finally:
+			os.close(fd)
+		return True
+	#end define
+
+	def close(self):
+		if self.mmap is not None:
+			self.mmap.close()
+			self.mmap = None
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+	#end define
+
+	def publish(self, data):
+		size = self.header.size + len(data)
+		if size > len(self.mmap):
+			size = max(size, len(self.mmap) * 2)
+			os.ftruncate(self.fd, size)
+			self.mmap.close()
+			self.mmap = mmap.mmap(self.fd, size)
+		self.sequence += 1
+		self.header.pack_into(self.mmap, 0, self.magic, self.sequence, len(data))
+		self.mmap[self.header.size:self.header.size + len(data)] = data
+		self.sequence += 1
+		self.header.pack_into(self.mmap, 0, self.magic, self.sequence, len(data))
+		self.stats["published"] += 1
+	#end define
+
+	def get_sequence(self):
+		if self.open_reader() is False:
+			return 0
+		return struct.unpack_from("<Q", self.mmap, self.sequence_offset)[0]
+	#end define
+
+	def read(self, max_retries=100):
+		'''Return (version, bytes) of a consistent snapshot or (None, None)'''
+		if self.open_reader() is False:
+			return None, None
+		for i in range(max_retries):
+			magic, sequence, length = self.header.unpack_from(self.mmap)
+			if magic != self.magic or sequence == 0:
+				return None, None
+			if sequence % 2 == 1:
+				self.stats["retries"] += 1
+				time.sleep(0)
+				continue
+			if self.header.size + length > len(self.mmap):
+				# The owner has grown the file, map it again
+				self.mmap.close()
+				self.mmap = None
+				self.open_reader()
+				continue
+			data = self.mmap[self.header.size:self.header.size + length]
+			if self.get_sequence() == sequence:
+				self.stats["loaded"] += 1
+				return sequence, data
+			self.stats["retries"] += 1
+		return None, None
+	#end define
+#end class
+
+
+def make_cycle_stats():
+	'''Counters of a cycle: overruns are runs longer than the interval,
+	skipped and queued are the runs due while the previous one was not finished,
+	cpu_time is the CPU seconds of the runs in their thread (not kept for coroutine
+	and process pool cycles, whose work is done elsewhere)'''
+	stats = Dict()
+	stats.runs = 0
+	stats.errors = 0
+	stats.overruns = 0
+	stats.skipped = 0
+	stats.queued = 0
+	stats.cpu_time = 0.0
+	stats.latency = LatencyHistogram()
+	return stats
+#end define
+
+
+class ScheduledJob:
+	'''Handle of a Scheduler job, call cancel() to stop it'''
+	max_pending = 100
+
+	def __init__(self, scheduler, target, name, interval, timing, jitter, overrun, stats=None):
+		self.scheduler = scheduler
+		self.target = target
+		self.name = name
+		self.interval = interval
+		self.timing = timing
+		self.jitter = jitter
+		self.overrun = overrun
+		self.base_time = None
+		self.running = 0
+		self.pending = 0
+		self.cancelled = False
+		if stats is None:
+			stats = make_cycle_stats()
+		self.stats = stats
+	#end define
+
+	def is_periodic(self):
+		return self.interval is not None
+	#end define
+
+	def cancel(self):
+		self.scheduler.cancel(self)
+	#end define
+#end class
+
+
+class Scheduler:
+	'''Runs periodic and one-shot jobs. One dispatcher thread keeps a heap of due times
+	and hands due jobs to a bounded pool of daemon worker threads.
+	Fixed rate jobs are due every interval from the first run, fixed delay jobs
+	an interval after the previous run has finished.'''
+	def __init__(self, max_workers=16):
+		self.max_workers = max_workers
+		self.heap = list()
+		self.counter = 0
+		self.condition = threading.Condition()
+		self.tasks = deque()
+		self.task_condition = threading.Condition()
+		self.workers = 0
+		self.idle_workers = 0
+		self.running = 0
+		self.thread = None
+		self.working = True
+	#end define
+
+	def configure(self, max_workers=None):
+		if max_workers is not None:
+			self.max_workers = max_workers
+	#end define
+
+	def start(self):
+		with self.condition:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+		self.thread.start()
+	#end define
+
+	def stop(self):
+		'''Stop starting new runs, runs in progress are not interrupted'''
+		with self.condition:
+			self.working = False
+			self.condition.notify_all()
+	#end define
+
+	def wait_idle(self, timeout=None):
+		'''Wait until no job is running, returns False on timeout'''
+		with self.condition:
+			return self.condition.wait_for(lambda: self.running == 0, timeout)
+	#end define
+
+	def schedule(self, target, name, interval=None, delay=0, timing=FIXED_RATE, jitter=0, overrun=SKIP, stats=None):
+		'''interval=0 runs the job again as soon as the previous run has finished'''
+		if interval is not None and interval < 0:
+			raise Exception(f"Scheduler error: negative interval {interval} of `{name}`")
+		if interval == 0:
+			timing = FIXED_DELAY
+		job = ScheduledJob(self, target, name, interval, timing, jitter, overrun, stats)
+		with self.condition:
+			job.base_time = time.monotonic() + delay
+			self.push(job, job.base_time)
+		self.start()
+		return job
+	#end define
+
+	def cancel(self, job):
+		with self.condition:
+			job.cancelled = True
+			job.pending = 0
+			self.condition.notify_all()
+	#end define
+
+	def push(self, job, due_time):
+		if job.jitter:
+			due_time += random.uniform(0, job.jitter)
+		self.counter += 1
+		heapq.heappush(self.heap, (due_time, self.counter, job))
+		if self.heap[0][2] is job:
+			self.condition.notify_all()
+	#end define
+
+	def run(self):
+		with self.condition:
+			while self.working:
+				if len(self.heap) == 0:
+					self.condition.wait()
+					continue
+				due_time, counter, job = self.heap[0]
+				if job.cancelled:
+					heapq.heappop(self.heap)
+					continue
+				now = time.monotonic()
+				if due_time > now:
+					self.condition.wait(due_time - now)
+					continue
+				heapq.heappop(self.heap)
+				try:
+					self.dispatch(job, now)
+				except Exception:
+					# The dispatcher is shared, a broken job only stops itself
+					job.stats["errors"] += 1
+					job.cancelled = True
+	#end define
+
+	def dispatch(self, job, now):
+		if job.running == 0 or job.overrun == CONCURRENT:
+			self.submit(job)
+		elif job.overrun == QUEUE and job.pending < job.max_pending:
+			job.stats["queued"] += 1
+			job.pending += 1
+		else:
+			job.stats["skipped"] += 1
+		if job.is_periodic() and job.timing == FIXED_RATE:
+			# Missed ticks are not caught up, the next run keeps the phase of the first one
+			job.base_time += job.interval
+			if job.base_time <= now:
+				missed = int((now - job.base_time) // job.interval) + 1
+				job.base_time += missed * job.interval
+			self.push(job, job.base_time)
+	#end define
+
+	def submit(self, job):
+		job.running += 1
+		self.running += 1
+		with self.task_condition:
+			self.tasks.append(job)
+			# Notified workers count as idle until they wake up, so compare with the queue
+			if len(self.tasks) > self.idle_workers and self.workers < self.max_workers:
+				self.workers += 1
+				threading.Thread(target=self.work, name="scheduler_worker", daemon=True).start()
+			self.task_condition.notify()
+	#end define
+
+	def work(self):
+		while True:
+			with self.task_condition:
+				while len(self.tasks) == 0:
+					self.idle_workers += 1
+					self.task_condition.wait()
+					self.idle_workers -= 1
+				job = self.tasks.popleft()
+			self.run_job(job)
+	#end define
+
+	def run_job(self, job):
+		# Log lines of the job are signed with its name, as with a dedicated thread
+		thread = threading.current_thread()
+		thread.name = job.name
+		start = time.perf_counter()
+		cpu_start = time.thread_time()
+		try:
+			job.target()
+		finally:
+			duration = time.perf_counter() - start
+			cpu_time = time.thread_time() - cpu_start
+			thread.name = "scheduler_worker"
+			with self.condition:
+				job.running -= 1
+				self.running -= 1
+				if self.running == 0:
+					self.condition.notify_all()
+				job.stats["runs"] += 1
+				job.stats["cpu_time"] += cpu_time
+				job.stats["latency"].add(duration)
+				if job.interval and duration > job.interval:
+					job.stats["overruns"] += 1
+				if job.cancelled or not self.working:
+					return
+				if job.pending > 0:
+					job.pending -= 1
+					self.submit(job)
+				elif job.is_periodic() and job.timing == FIXED_DELAY and job.running == 0:
+					job.base_time = time.monotonic() + job.interval
+					self.push(job, job.base_time)
+	#end define
+#end class
+
+
+class RingBuffer:
+	'''Fixed size ring of floats backed by array("d")'''
+	def __init__(self, size):
+		self.data = array.array('d', [0.0] * size)
+		self.size = size
+		self.index = 0
+		self.count = 0
+	#end define
+
+	def append(self, value):
+		self.data[self.index] = value
+		self.index = (self.index + 1) % self.size
+		if self.count < self.size:
+			self.count += 1
+	#end define
+
+	def values(self):
+		'''Values from the oldest to the newest'''
+		start = (self.index - self.count) % self.size
+		if start + self.count <= self.size:
+			return self.data[start:start + self.count].tolist()
+		return self.data[start:].tolist() + self.data[:self.index].tolist()
+	#end define
+#end class
+
+
+class MetricHistory:
+	'''Samples of one metric in rings of 1 s, 1 min and 1 h resolution,
+	a coarser ring gets the mean of the samples of its period'''
+	levels = [(1, 300), (60, 240), (3600, 168)]
+
+	def __init__(self):
+		self.rings = [RingBuffer(size) for period, size in self.levels]
+		self.sums = [0.0] * len(self.levels)
+		self.counts = [0] * len(self.levels)
+		self.periods = [None] * len(self.levels)
+	#end define
+
+	def add(self, value, now):
+		self.rings[0].append(value)
+		for level in range(1, len(self.levels)):
+			period = int(now // self.levels[level][0])
+			if period != self.periods[level] and self.counts[level] > 0:
+				self.rings[level].append(self.sums[level] / self.counts[level])
+				self.sums[level] = 0.0
+				self.counts[level] = 0
+			self.periods[level] = period
+			self.sums[level] += value
+			self.counts[level] += 1
+	#end define
+
+	def get(self, resolution=1):
+		for level, (period, size) in enumerate(self.levels):
+			if period == resolution:
+				return self.rings[level].values()
+		raise Exception(f"MetricHistory error: no {resolution} sec resolution")
+	#end define
+
+	def get_slope(self, resolution=60, count=30):
+		'''Least squares slope of the last `count` samples, per second'''
+		values = self.get(resolution)[-count:]
+		n = len(values)
+		if n < 2:
+			return None
+		mean_x = (n - 1) / 2
+		mean_y = sum(values) / n
+		numerator = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+		denominator = sum((x - mean_x) ** 2 for x in range(n))
+		return numerator / denominator / resolution
+	#end define
+#end class
+
+
+class ResourceMonitor:
+	'''Samples memory, CPU, open files, context switches and per-thread CPU time
+	of the current process from /proc/self, or from one cached psutil.Process
+	where /proc is not available'''
+	def __init__(self):
+		self.is_proc = os.path.isfile("/proc/self/statm")
+		self.page_size = os.sysconf("SC_PAGE_SIZE") if self.is_proc else None
+		self.clock_ticks = os.sysconf("SC_CLK_TCK") if self.is_proc else None
+		self.process = None
+		self.last_cpu_time = None
+		self.last_time = None
+		self.history = dict()
+	#end define
+
+	def sample(self):
+		if self.is_proc:
+			result = self.sample_proc()
+		else:
+			result = self.sample_psutil()
+		now = time.time()
+		cpu_time = result.pop("cpu_time")
+		if self.last_time is not None and now > self.last_time:
+			result.cpu_percent = round((cpu_time - self.last_cpu_time) / (now - self.last_time) * 100, 1)
+		else:
+			result.cpu_percent = 0.0
+		self.last_cpu_time = cpu_time
+		self.last_time = now
+		for key, value in result.items():
+			if isinstance(value, (int, float)):
+				self.history.setdefault(key, MetricHistory()).add(value, now)
+		return result
+	#end define
+
+	def sample_proc(self):
+		result = Dict()
+		with open("/proc/self/statm", 'rb') as file:
+			result.memory_using = b2mb(int(file.read().split()[1]) * self.page_size)
+		with open("/proc/self/stat", 'rb') as file:
+			# Fields after the command name, which may contain spaces
+			fields = file.read().rsplit(b')', 1)[1].split()
+		result.cpu_time = (int(fields[11]) + int(fields[12])) / self.clock_ticks
+		result.threads = int(fields[17])
+		with open("/proc/self/status", 'rb') as file:
+			for line in file:
+				if line.startswith(b"voluntary_ctxt_switches"):
+					result.ctx_switches_voluntary = int(line.split()[1])
+				elif line.startswith(b"nonvoluntary_ctxt_switches"):
+					result.ctx_switches_involuntary = int(line.split()[1])
+		result.fds = len(os.listdir("/proc/self/fd"))
+		with open("/proc/meminfo", 'rb') as file:
+			for line in file:
+				if line.startswith(b"MemAvailable:"):
+					result.free_space_memory = b2mb(int(line.split()[1]) * 1024)
+					break
+		result.thread_cpu = self.read_thread_cpu()
+		return result
+	#end define
+
+	def read_thread_cpu(self):
+		'''{native thread id: (user, system) CPU seconds}'''
+		result = dict()
+		for name in os.listdir("/proc/self/task"):
+			try:
+				with open(f"/proc/self/task/{name}/stat", 'rb') as file:
+					fields = file.read().rsplit(b')', 1)[1].split()
+			except FileNotFoundError:
+				continue  # the thread has just exited
+			result[int(name)] = (int(fields[11]) / self.clock_ticks, int(fields[12]) / self.clock_ticks)
+		return result
+	#end define
+
+	def sample_psutil(self):
+		if self.process is None:
+			self.process = psutil.Process(os.getpid())
+		process = self.process
+		result = Dict()
+		with process.oneshot():
+			result.memory_using = b2mb(process.memory_info().rss)
+			cpu_times = process.cpu_times()
+			result.cpu_time = cpu_times.user + cpu_times.system
+			result.threads = process.num_threads()
+			ctx_switches = process.num_ctx_switches()
+			result.ctx_switches_voluntary = ctx_switches.voluntary
+			result.ctx_switches_involuntary = ctx_switches.involuntary
+			result.fds = process.num_fds() if hasattr(process, "num_fds") else None
+			result.thread_cpu = {thread.id: (thread.user_time, thread.system_time) for thread in process.threads()}
+		result.free_space_memory = b2mb(psutil.virtual_memory().available)
+		return result
+	#end define
+#end class
+
+
+class MemoryTracer:
+	'''tracemalloc snapshots for leak hunting: every report compares a new snapshot
+	with the previous one and appends the top allocation sites with tracebacks to a file'''
+	def __init__(self):
+		self.is_started = False
+		self.snapshot = None
+		self.last_time = None
+		self.is_alert_reported = False
+		self.stats = Dict()
+		self.stats.reports = 0
+	#end define
+
+	def start(self, frames):
+		if not tracemalloc.is_tracing():
+			tracemalloc.start(frames)
+		self.is_started = True
+		self.snapshot = self.take_snapshot()
+		self.last_time = time.time()
+	#end define
+
+	def stop(self):
+		if tracemalloc.is_tracing():
+			tracemalloc.stop()
+		self.is_started = False
+		self.snapshot = None
+		self.is_alert_reported = False
+	#end define
+
+	def get_overhead(self):
+		'''Memory used by tracemalloc itself in bytes'''
+		return tracemalloc.get_tracemalloc_memory()
+	#end define
+
+	def take_snapshot(self):
+		return tracemalloc.take_snapshot().filter_traces([
+			tracemalloc.Filter(False, tracemalloc.__file__),
+			tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+			tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+			tracemalloc.Filter(False, "<unknown>"),
+		])
+	#end define
+
+	def report(self, path, reason, top=20):
+		snapshot = self.take_snapshot()
+		stats = snapshot.compare_to(self.snapshot, "traceback")[:top]
+		current, peak = tracemalloc.get_traced_memory()
+		time_text = timestamp2datetime(int(time.time()))
+		lines = [f"=== {time_text} {reason}: traced {b2mb(current)}Mb, peak {b2mb(peak)}Mb, tracemalloc {b2mb(self.get_overhead())}Mb"]
+		for stat in stats:
+			lines.append(f"{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} blocks, total {stat.size / 1024:.1f} KiB")
+			lines += ["    " + line for line in stat.traceback.format()]
+		with open(path, 'at') as file:
+			file.write('\n'.join(lines) + '\n\n')
+		self.snapshot = snapshot
+		self.last_time = time.time()
+		self.stats["reports"] += 1
+	#end define
+#end class
+
+
+class SamplingProfiler:
+	'''Wall clock sampling profiler: a thread takes the stacks of all other threads
+	from sys._current_frames() `hz` times per second and counts them by thread name.
+	write() saves them as collapsed stacks ("thread;outer;inner count") for flamegraph tools.'''
+	def __init__(self):
+		self.thread = None
+		self.working = False
+		self.interval = 0.01
+		self.counts = dict()
+		self.labels = dict()
+		self.stats = Dict()
+		self.stats.samples = 0
+		self.stats.sample_time = 0.0
+		self.stats.run_time = 0.0
+		self.stats.overhead_percent = 0.0
+	#end define
+
+	def start(self, hz=100):
+		if self.working:
+			return
+		self.interval = 1 / hz
+		self.working = True
+		self.thread = threading.Thread(target=self.run, name="sampling_profiler", daemon=True)
+		self.thread.start()
+	#end define
+
+	def stop(self):
+		self.working = False
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+	#end define
+
+	def get_label(self, code):
+		label = self.labels.get(code)
+		if label is None:
+			file_name = os.path.basename(code.co_filename)
+			label = f"{code.co_name} ({file_name}:{code.co_firstlineno})".replace(';', ':')
+			self.labels[code] = label
+		return label
+	#end define
+
+	def run(self):
+		own_ident = threading.get_ident()
+		last_time = time.perf_counter()
+		next_time = last_time
+		while self.working:
+			sample_start = time.perf_counter()
+			self.sample(own_ident)
+			now = time.perf_counter()
+			# Time spent sampling holds the GIL, relative to the time profiled it is the overhead
+			self.stats["samples"] += 1
+			self.stats["sample_time"] += now - sample_start
+			self.stats["run_time"] += now - last_time
+			self.stats["overhead_percent"] = round(self.stats["sample_time"] / self.stats["run_time"] * 100, 3)
+			last_time = now
+			next_time += self.interval
+			if next_time < now:
+				next_time = now + self.interval  # do not catch up missed samples
+			time.sleep(next_time - now)
+	#end define
+
+	def sample(self, own_ident):
+		names = {thread.ident: thread.name for thread in threading.enumerate()}
+		counts = self.counts
+		for ident, frame in sys._current_frames().items():
+			if ident == own_ident:
+				continue
+			stack = list()
+			while frame is not None:
+				stack.append(self.get_label(frame.f_code))
+				frame = frame.f_back
+			stack.append(names.get(ident, str(ident)).replace(';', ':'))
+			stack.reverse()
+			key = tuple(stack)
+			counts[key] = counts.get(key, 0) + 1
 	#end define
 
-	colors = {"red": red, "green": green, "yellow": yellow, "blue": blue, "magenta": magenta, "cyan": cyan,
-			  "endc": endc, "bold": bold, "underline": underline}
+	def write(self, path):
+		counts = dict(self.counts)
+		lines = [f"{';'.join(stack)} {count}" for stack, count in sorted(counts.items())]
+		with open(path, 'wt') as file:
+			file.write('\n'.join(lines) + '\n')
+	#end define
 #end class
 
 
+# Set in process pool workers by init_process_worker
+process_log_queue = None
+process_job_name = None
+
+def init_process_worker(log_queue):
+	global process_log_queue
+	process_log_queue = log_queue
+#end define
+
+def run_process_job(func, name, args):
+	global process_job_name
+	process_job_name = name
+	if args is None:
+		return func()
+	return func(*args)
+#end define
+
+def is_process_worker():
+	'''True in a process pool worker, also while it imports the main script again'''
+	return multiprocessing.parent_process() is not None or getattr(multiprocessing.current_process(), "_inheriting", False)
+#end define
+
+def add_process_log(input_text, *args, mode=INFO):
+	'''add_log for functions running in MyPyClass.submit() workers,
+	the line is forwarded to add_log of the parent process'''
+	if args:
+		try:
+			input_text = input_text % args
+		except (TypeError, ValueError):
+			input_text = f"{input_text} {args}"
+	if process_log_queue is None:
+		print(input_text)
+		return
+	process_log_queue.put((mode, process_job_name or multiprocessing.current_process().name, f"{input_text}"))
+#end define
+
+
 class MyPyClass:
 	def __init__(self, file):
 		self.working = True
 		self.file = file
-		self.db = Dict()
+		self.is_process_worker = is_process_worker()
+		self.db_tracker = DirtyTracker()
+		self.db = Dict()  # a TrackedDict once saving or the shared db needs it, see track_db
 		self.db.config = Dict()
+		self.old_db = Dict()  # old side of the save_db merge, Dict or DictSnapshot
 
 		self.buffer = Dict()
-		self.buffer.old_db = Dict()
-		self.buffer.log_list = list()
+		self.buffer.db_file_stat = None
+		self.buffer.db_stats = Dict()
+		self.buffer.db_stats.reads = 0
+		self.buffer.db_stats.cache_hits = 0
+		self.buffer.db_stats.watch_events = 0
+		self.buffer.db_stats.journal_records = 0
+		self.buffer.db_stats.compactions = 0
+		self.buffer.db_stats.conflicts = 0
+		self.buffer.db_journal_size = 0
+		self.db_compacting = False
+		self.db_read_cache = dict()
+		self.db_serializers = dict()
+		for serializer in [JsonSerializer(), CompactJsonSerializer(), MarshalSerializer(), PickleSerializer()]:
+			self.add_db_serializer(serializer)
+		if msgpack is not None:
+			self.add_db_serializer(MsgpackSerializer())
+		self.db_save_lock = threading.RLock()
+		self.file_locks = dict()
+		self.db_watcher = None
+		self.shared_db = None
+		self.scheduler = Scheduler()
+		self.process_pool = None
+		self.process_pool_lock = threading.Lock()
+		self.loop = None
+		self.metrics_server = None
+		self.resource_monitor = ResourceMonitor()
+		self.memory_tracer = MemoryTracer()
+		self.buffer.memory_trace_stats = self.memory_tracer.stats
+		self.is_memory_trace_toggled = False
+		self.profiler = SamplingProfiler()
+		self.profiler_write_time = None
+		self.is_profiler_toggled = False
+		self.buffer.profiler_stats = self.profiler.stats
+		self.buffer.resources = None
+		self.buffer.thread_stats = Dict()
+		self.buffer.top_threads = list()
+		self.thread_cpu_time = None
+		self.buffer.resource_alerts = Dict()
+		self.shutdown_lock = threading.Lock()
+		self.shutdown_thread = None
+		self.is_shutdown_done = False
+		self.log_write_lock = threading.Lock()
+		self.buffer.shutdown_stats = None
+		self.buffer.cycle_stats = Dict()
+		self.buffer.db_save_latency = LatencyHistogram()
+		self.log_mode_prefixes = dict()
+		self.log_thread_prefixes = dict()
+		self.log_time_cache = (None, None, None, None)
+		self.log_queue = LogQueue()
+		self.buffer.log_stats = self.log_queue.stats
+		self.log_rotator = LogRotator()
+		self.buffer.log_rotate_stats = self.log_rotator.stats
+		self.console_writer = ConsoleWriter(self.format_log_record)
+		self.json_log_writer = JsonLogWriter()
+		self.buffer.json_log_stats = self.json_log_writer.stats
+		self.log_rate_limiter = LogRateLimiter()
+		self.buffer.log_rate_stats = self.log_rate_limiter.stats
+		self.buffer.console_stats = self.console_writer.queue.stats
 		self.buffer.thread_count = None
 		self.buffer.memory_using = None
 		self.buffer.free_space_memory = None
 		
 		self.refresh()
+		if self.is_process_worker:
+			return  # the signals belong to the pool
 		
 		# Catch the shutdown signal
 		signal.signal(signal.SIGINT, self.exit)
 		signal.signal(signal.SIGTERM, self.exit)
+		signal.signal(signal.SIGUSR2, self.toggle_memory_trace)
+		signal.signal(signal.SIGUSR1, self.toggle_profiler)
 	#end define
 
 	def refresh(self):
@@ -172,19 +2422,34 @@ class MyPyClass:
 		self.buffer.my_temp_dir = self.get_my_temp_dir()
 		self.buffer.log_file_name = my_work_dir + my_name + ".log"
 		self.buffer.db_path = my_work_dir + my_name + ".db"
+		self.buffer.db_journal_path = self.buffer.db_path + ".journal"
+		self.buffer.shared_db_path = self.buffer.my_temp_dir + my_name + ".shm"
 		self.buffer.pid_file_path = my_work_dir + my_name + ".pid"
+		self.buffer.memory_trace_path = my_work_dir + my_name + ".memtrace"
+		self.buffer.profile_path = my_work_dir + my_name + ".folded"
+		self.buffer.json_log_file_name = my_work_dir + my_name + ".jsonl"
+		self.log_rotator.set_path(self.buffer.log_file_name)
+		self.json_log_writer.configure(path=self.buffer.json_log_file_name)
+		self.buffer.db_lock_stats = self.get_file_lock(self.buffer.db_path).stats
+		if self.is_process_worker:
+			# The script is imported again in process pool workers,
+			# the files of the parent process are left alone
+			self.set_default_config()
+			return
 		
 		# Check all directorys
 		os.makedirs(self.buffer.my_work_dir, exist_ok=True)
-		os.makedirs(self.buffer.my_temp_dir, exist_ok=True)
+		os.makedirs(self.buffer.my_temp_dir, mode=0o700, exist_ok=True)
 		
 		# Load local database
 		self.load_db()
 		self.set_default_config()
 		
 		# Remove old log file
-		if self.db.config.isDeleteOldLogFile and os.path.isfile(self.buffer.log_file_name):
-			os.remove(self.buffer.log_file_name)
+		if self.db.config.isDeleteOldLogFile:
+			for path in [self.buffer.log_file_name, self.buffer.json_log_file_name, self.buffer.json_log_file_name + ".idx"]:
+				if os.path.isfile(path):
+					os.remove(path)
 		#end if
 	#end define
 
@@ -208,12 +2473,33 @@ class MyPyClass:
 			self.start_only_one_process()
 		#end if
 
+		# Apply log queue settings
+		self.log_queue.configure(self.db.config.logQueueSize, self.db.config.logQueueOverflow)
+		self.configure_log_rotator()
+		self.json_log_writer.configure(bucket=self.db.config.logIndexBucket)
+		if self.db.config.isLimitLogFile is False:
+			self.json_log_writer.set_retention()
+		else:
+			self.json_log_writer.set_retention(self.db.config.jsonLogMaxBytes, self.db.config.logRotateBackupCount)
+		self.log_rate_limiter.configure(self.db.config.logRateBurst, self.db.config.logRateSample, self.db.config.logRateWindow)
+		self.console_writer.configure(self.db.config.consoleQueueSize, self.db.config.consoleQueueOverflow, self.db.config.logColors)
+
 		# Start other threads
+		self.scheduler.configure(self.db.config.schedulerWorkers)
+		self.console_writer.start()
 		self.start_cycle(self.self_test, sec=1)
-		if self.db.config.isWritingLogFile is True:
-			self.start_cycle(self.write_log, sec=1)
+		self.start_cycle(self.report_suppressed_logs, sec=self.db.config.logRateSummaryInterval)
+		if self.db.config.isWritingLogFile is True or self.db.config.isWritingJsonLog is True:
+			self.start_thread(self.run_log_flusher, name="write_log")
 		if self.db.config.isLocaldbSaving is True:
-			self.start_cycle(self.save_db, sec=1)
+			self.track_db()
+			self.start_thread(self.run_db_flusher, name="save_db")
+			if self.db.config.isDbWatch is True:
+				self.start_db_watcher()
+		if self.db.config.dbSharedMode in ("owner", "reader"):
+			self.start_shared_db(self.db.config.dbSharedMode)
+		if self.db.config.metricsPort or self.db.config.metricsSocket:
+			self.start_metrics_server()
 		self.buffer.thread_count_old = threading.active_count()
 
 		# Logging the start of the program
@@ -233,10 +2519,108 @@ class MyPyClass:
 			self.db.config.isStartOnlyOneProcess = True
 		if self.db.config.memoryUsinglimit is None:
 			self.db.config.memoryUsinglimit = 50
+		if self.db.config.memoryTrendLimit is None:
+			self.db.config.memoryTrendLimit = 100  # Mb per hour over the last 30 minutes
+		if self.db.config.isMemoryTrace is None:
+			self.db.config.isMemoryTrace = False
+		if self.db.config.memoryTraceFrames is None:
+			self.db.config.memoryTraceFrames = 5
+		if self.db.config.memoryTraceInterval is None:
+			self.db.config.memoryTraceInterval = 300
+		if self.db.config.memoryTraceTop is None:
+			self.db.config.memoryTraceTop = 20
+		if self.db.config.memoryTraceMaxMb is None:
+			self.db.config.memoryTraceMaxMb = 64  # tracing is stopped above this overhead
+		if self.db.config.isProfiling is None:
+			self.db.config.isProfiling = False
+		if self.db.config.profilerHz is None:
+			self.db.config.profilerHz = 100
+		if self.db.config.profilerWriteInterval is None:
+			self.db.config.profilerWriteInterval = 60
+		if self.db.config.cpuUsingLimit is None:
+			self.db.config.cpuUsingLimit = 90  # percent of one core
 		if self.db.config.isLocaldbSaving is None:
 			self.db.config.isLocaldbSaving = False
 		if self.db.config.isWritingLogFile is None:
 			self.db.config.isWritingLogFile = True
+		if self.db.config.isWritingJsonLog is None:
+			self.db.config.isWritingJsonLog = False
+		if self.db.config.logIndexBucket is None:
+			self.db.config.logIndexBucket = 60
+		if self.db.config.jsonLogMaxBytes is None:
+			self.db.config.jsonLogMaxBytes = 64 * 1024 * 1024  # rotated with logRotateBackupCount segments
+		if self.db.config.dbFormat is None:
+			self.db.config.dbFormat = "json"  # json || json_compact || marshal || pickle || msgpack
+		if self.db.config.isDbJournal is None:
+			self.db.config.isDbJournal = False
+		if self.db.config.dbJournalMaxSize is None:
+			self.db.config.dbJournalMaxSize = 4 * 1024 * 1024
+		if self.db.config.isDbWatch is None:
+			self.db.config.isDbWatch = False
+		if self.db.config.dbFlushLatency is None:
+			self.db.config.dbFlushLatency = 1  # seconds from the first change to save_db
+		if self.db.config.dbFlushMaxIdle is None:
+			self.db.config.dbFlushMaxIdle = 8  # max seconds between file checks of an unchanged db
+		if self.db.config.logFlushLatency is None:
+			self.db.config.logFlushLatency = 0.05
+		if self.db.config.logFlushLines is None:
+			self.db.config.logFlushLines = 1000
+		if self.db.config.metricsPort is None:
+			self.db.config.metricsPort = False  # localhost port of the Prometheus endpoint
+		if self.db.config.metricsSocket is None:
+			self.db.config.metricsSocket = False  # or the path of a Unix socket
+		if self.db.config.shutdownTimeout is None:
+			self.db.config.shutdownTimeout = 10  # seconds to wait for running cycles on exit
+		if self.db.config.schedulerWorkers is None:
+			self.db.config.schedulerWorkers = 16
+		if self.db.config.dbSharedMode is None:
+			self.db.config.dbSharedMode = False  # False || owner || reader
+		if self.db.config.dbSharedInterval is None:
+			self.db.config.dbSharedInterval = 0.01
+		if self.db.config.isLogRateLimit is None:
+			self.db.config.isLogRateLimit = False
+		if self.db.config.logRateKey is None:
+			self.db.config.logRateKey = "site"  # site || template
+		if self.db.config.logRateBurst is None:
+			self.db.config.logRateBurst = 10
+		if self.db.config.logRateSample is None:
+			self.db.config.logRateSample = 100
+		if self.db.config.logRateWindow is None:
+			self.db.config.logRateWindow = 60
+		if self.db.config.logRateSummaryInterval is None:
+			self.db.config.logRateSummaryInterval = 60
+		if self.db.config.logQueueSize is None:
+			self.db.config.logQueueSize = 65536
+		if self.db.config.logQueueOverflow is None:
+			self.db.config.logQueueOverflow = BLOCK  # block || drop_oldest || drop_newest
+		if self.db.config.consoleQueueSize is None:
+			self.db.config.consoleQueueSize = 65536
+		if self.db.config.consoleQueueOverflow is None:
+			self.db.config.consoleQueueOverflow = DROP_OLDEST  # block || drop_oldest || drop_newest
+		if self.db.config.logColors is None:
+			self.db.config.logColors = "auto"  # auto || true || false
+		if self.db.config.logRotateMaxLines is None:
+			self.db.config.logRotateMaxLines = 4096
+		if self.db.config.logRotateNaming is None:
+			self.db.config.logRotateNaming = NUMBERED  # numbered || timestamped
+		if self.db.config.logRotateCompress is None:
+			self.db.config.logRotateCompress = False
+		if self.db.config.logRotateBackupCount is None:
+			self.db.config.logRotateBackupCount = 1
+	#end define
+
+	def configure_log_rotator(self):
+		config = self.db.config
+		if config.isLimitLogFile is False:
+			self.log_rotator.configure()
+			return
+		self.log_rotator.configure(
+			max_bytes=config.logRotateMaxBytes,
+			max_lines=config.logRotateMaxLines,
+			interval=config.logRotateInterval,
+			naming=config.logRotateNaming,
+			compress=config.logRotateCompress,
+			backup_count=config.logRotateBackupCount)
 	#end define
 
 	def start_only_one_process(self):
@@ -267,16 +2651,221 @@ class MyPyClass:
 	#end define
 
 	def self_test(self):
-		process = psutil.Process(os.getpid())
-		memory_using = b2mb(process.memory_info().rss)
-		free_space_memory = b2mb(psutil.virtual_memory().available)
-		thread_count = threading.active_count()
-		self.buffer.free_space_memory = free_space_memory
-		self.buffer.memory_using = memory_using
-		self.buffer.thread_count = thread_count
-		if memory_using > self.db.config.memoryUsinglimit:
-			self.db.config.memoryUsinglimit += 50
-			self.add_log(f"Memory using: {memory_using}Mb, free: {free_space_memory}Mb", WARNING)
+		resources = self.resource_monitor.sample()
+		self.update_thread_stats(resources.pop("thread_cpu"))
+		self.buffer.resources = resources
+		self.buffer.free_space_memory = resources.free_space_memory
+		self.buffer.memory_using = resources.memory_using
+		self.buffer.thread_count = threading.active_count()
+
+		# Alerts are raised once when a limit is crossed and cleared below 90% of it
+		memory_text = f"Memory using: {resources.memory_using}Mb, free: {resources.free_space_memory}Mb"
+		self.check_resource_alert("memory", resources.memory_using, self.db.config.memoryUsinglimit, memory_text)
+		slope = self.resource_monitor.history["memory_using"].get_slope(60, 30)
+		if slope is not None and self.resource_monitor.history["memory_using"].rings[1].count >= 10:
+			growth = round(slope * 3600, 1)
+			self.check_resource_alert("memory_trend", growth, self.db.config.memoryTrendLimit, f"Memory is growing by {growth}Mb/h, {memory_text}")
+		self.check_resource_alert("cpu", resources.cpu_percent, self.db.config.cpuUsingLimit, f"CPU using: {resources.cpu_percent}%")
+		self.check_memory_trace()
+		self.check_profiler()
+	#end define
+
+	def toggle_profiler(self, signum=None, frame=None):
+		'''SIGUSR1 handler, the next self_test starts or stops the profiler.
+		The db is not touched here, the interrupted thread may hold its lock.'''
+		self.is_profiler_toggled = not self.is_profiler_toggled
+	#end define
+
+	def check_profiler(self):
+		'''Start or stop the profiler by isProfiling, the collapsed stacks are written
+		to buffer.profile_path every profilerWriteInterval seconds and on stop'''
+		config = self.db.config
+		profiler = self.profiler
+		if self.is_profiler_toggled:
+			self.is_profiler_toggled = False
+			config.isProfiling = not config.isProfiling
+		if config.isProfiling and not profiler.working:
+			profiler.start(config.profilerHz)
+			self.profiler_write_time = time.time()
+			self.add_log(f"Profiler started at {config.profilerHz} Hz, stacks go to {self.buffer.profile_path}")
+		elif not config.isProfiling and profiler.working:
+			profiler.stop()
+			profiler.write(self.buffer.profile_path)
+			self.add_log(f"Profiler stopped: {profiler.stats.samples} samples, overhead {profiler.stats.overhead_percent}%")
+		elif profiler.working and time.time() - self.profiler_write_time >= config.profilerWriteInterval:
+			profiler.write(self.buffer.profile_path)
+			self.profiler_write_time = time.time()
+	#end define
+
+	def toggle_memory_trace(self, signum=None, frame=None):
+		'''SIGUSR2 handler, the next self_test starts or stops tracing.
+		The db is not touched here, the interrupted thread may hold its lock.'''
+		self.is_memory_trace_toggled = not self.is_memory_trace_toggled
+	#end define
+
+	def check_memory_trace(self):
+		'''With isMemoryTrace, report the allocations made since tracing started when the memory
+		limit is crossed, then every memoryTraceInterval seconds while memory alerts last'''
+		config = self.db.config
+		tracer = self.memory_tracer
+		if self.is_memory_trace_toggled:
+			self.is_memory_trace_toggled = False
+			config.isMemoryTrace = not config.isMemoryTrace
+		if config.isMemoryTrace and not tracer.is_started:
+			tracer.start(config.memoryTraceFrames)
+			self.add_log(f"Memory trace started, reports go to {self.buffer.memory_trace_path}")
+		elif not config.isMemoryTrace and tracer.is_started:
+			tracer.stop()
+			self.add_log("Memory trace stopped")
+		if not tracer.is_started:
+			return
+		overhead = tracer.get_overhead()
+		if overhead > config.memoryTraceMaxMb * 1024 * 1024:
+			tracer.stop()
+			config.isMemoryTrace = False
+			self.add_log(f"Memory trace stopped: tracemalloc uses {b2mb(overhead)}Mb", mode=WARNING)
+			return
+		#end if
+
+		alerts = self.buffer.resource_alerts
+		is_alert = alerts.get("memory") or alerts.get("memory_trend")
+		if is_alert and not tracer.is_alert_reported:
+			tracer.is_alert_reported = True
+			tracer.report(self.buffer.memory_trace_path, "memory limit crossed", config.memoryTraceTop)
+		elif is_alert and time.time() - tracer.last_time >= config.memoryTraceInterval:
+			tracer.report(self.buffer.memory_trace_path, "interval", config.memoryTraceTop)
+		elif not is_alert:
+			tracer.is_alert_reported = False
+	#end define
+
+	def update_thread_stats(self, thread_cpu, top=5):
+		'''Per-thread CPU usage since the previous self_test by native thread id,
+		named after the Python thread running on it. Scheduler workers take the name
+		of their current job, the CPU of each cycle is in its cycle_stats cpu_time.'''
+		now = time.time()
+		names = {thread.native_id: thread.name for thread in threading.enumerate()}
+		previous = self.thread_cpu_time
+		self.thread_cpu_time = (now, thread_cpu)
+		if previous is None:
+			return
+		interval = now - previous[0]
+		thread_stats = Dict()
+		for tid, (user_time, system_time) in thread_cpu.items():
+			last_user_time, last_system_time = previous[1].get(tid, (0.0, 0.0))  # a new thread
+			item = Dict()
+			item.name = names.get(tid, f"native_{tid}")
+			item.tid = tid
+			item.user_time = round(user_time, 2)
+			item.system_time = round(system_time, 2)
+			item.cpu_percent = round((user_time + system_time - last_user_time - last_system_time) / interval * 100, 1)
+			thread_stats[str(tid)] = item
+		self.buffer.thread_stats = thread_stats
+		top_threads = sorted(thread_stats.values(), key=lambda item: -item.cpu_percent)[:top]
+		self.buffer.top_threads = [[item.name, item.tid, item.cpu_percent] for item in top_threads]
+	#end define
+
+	def check_resource_alert(self, name, value, limit, text):
+		alerts = self.buffer.resource_alerts
+		if value is None or not limit:
+			return
+		if not alerts.get(name) and value > limit:
+			alerts[name] = True
+			self.add_log(text, mode=WARNING)
+		elif alerts.get(name) and value < limit * 0.9:
+			alerts[name] = False
+			self.add_log(f"{text} (back to normal)")
+	#end define
+
+	def get_resource_history(self, name, resolution=1):
+		'''Values of a self_test metric, e.g. ("memory_using", 60) for the per minute means'''
+		history = self.resource_monitor.history.get(name)
+		if history is None:
+			return list()
+		return history.get(resolution)
+	#end define
+
+	def start_metrics_server(self):
+		'''Serve get_metrics_text() over HTTP on localhost:metricsPort or on the metricsSocket Unix socket'''
+		local = self
+
+		class MetricsHandler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = local.get_metrics_text().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+			#end define
+
+			def log_message(self, format, *args):
+				pass
+			#end define
+		#end class
+
+		socket_path = self.db.config.metricsSocket
+		if socket_path:
+			# Only a stale socket is removed, never a file set by mistake
+			if os.path.lexists(socket_path):
+				if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+					self.add_log("start_metrics_server error: `%s` is not a socket", socket_path, mode=ERROR)
+					return
+				os.remove(socket_path)
+			self.metrics_server = socketserver.UnixStreamServer(socket_path, MetricsHandler)
+		else:
+			self.metrics_server = http.server.HTTPServer(("127.0.0.1", self.db.config.metricsPort), MetricsHandler)
+		self.start_thread(self.metrics_server.serve_forever, name="metrics_server")
+	#end define
+
+	def get_metrics_text(self):
+		'''Metrics in the Prometheus text format'''
+		lines = list()
+		def add_metric(name, kind, values):
+			lines.append(f"# TYPE mypylib_{name} {kind}")
+			for labels, value in values:
+				lines.append(f"mypylib_{name}{labels} {value}")
+		#end define
+
+		cycles = sorted(self.buffer.cycle_stats.items())
+		for key in ["runs", "errors", "overruns", "skipped", "queued"]:
+			add_metric(f"cycle_{key}_total", "counter", [(get_metric_labels(cycle=name), stats[key]) for name, stats in cycles])
+		add_metric("cycle_cpu_seconds_total", "counter", [(get_metric_labels(cycle=name), round(stats["cpu_time"], 6)) for name, stats in cycles])
+		lines.append("# TYPE mypylib_cycle_duration_seconds histogram")
+		for name, stats in cycles:
+			lines += get_histogram_lines("mypylib_cycle_duration_seconds", stats["latency"], cycle=name)
+		lines.append("# TYPE mypylib_db_save_duration_seconds histogram")
+		lines += get_histogram_lines("mypylib_db_save_duration_seconds", self.buffer.db_save_latency)
+		add_metric("db_events_total", "counter", [(get_metric_labels(event=key), value) for key, value in self.buffer.db_stats.items()])
+
+		add_metric("log_queue_length", "gauge", [("", len(self.log_queue))])
+		add_metric("console_queue_length", "gauge", [("", len(self.console_writer.queue))])
+		dropped = list()
+		for queue_name, stats in [("log", self.log_queue.stats), ("console", self.console_writer.queue.stats)]:
+			for key, value in stats.items():
+				dropped.append((get_metric_labels(queue=queue_name, policy=key), value))
+		add_metric("log_dropped_total", "counter", dropped)
+		add_metric("log_suppressed_total", "counter", [("", self.log_rate_limiter.stats["suppressed"])])
+
+		# self_test values, absent until the first self_test
+		for name, value in [("memory_using_megabytes", self.buffer.memory_using),
+			("free_memory_megabytes", self.buffer.free_space_memory),
+			("threads", self.buffer.thread_count)]:
+			if value is not None:
+				add_metric(name, "gauge", [("", value)])
+		resources = self.buffer.resources
+		if resources is not None:
+			add_metric("cpu_percent", "gauge", [("", resources.cpu_percent)])
+			if resources.fds is not None:
+				add_metric("open_files", "gauge", [("", resources.fds)])
+			add_metric("context_switches_total", "counter", [
+				(get_metric_labels(kind="voluntary"), resources.ctx_switches_voluntary),
+				(get_metric_labels(kind="involuntary"), resources.ctx_switches_involuntary)])
+		thread_values = list()
+		for item in self.buffer.thread_stats.values():
+			thread_values.append((get_metric_labels(thread=item.name, tid=item.tid, mode="user"), item.user_time))
+			thread_values.append((get_metric_labels(thread=item.name, tid=item.tid, mode="system"), item.system_time))
+		add_metric("thread_cpu_seconds_total", "counter", thread_values)
+		return '\n'.join(lines) + '\n'
 	#end define
 
 	def print_self_testing_result(self):
@@ -287,6 +2876,17 @@ class MyPyClass:
 		self.add_log(color_text("{blue}Self testing informatinon:{endc}"))
 		self.add_log(f"Threads: {thread_count_new} -> {thread_count_old}")
 		self.add_log(f"Memory using: {memory_using}Mb, free: {free_space_memory}Mb")
+		resources = self.buffer.resources
+		if resources is not None:
+			self.add_log(f"CPU using: {resources.cpu_percent}%, open files: {resources.fds}, context switches: {resources.ctx_switches_voluntary}/{resources.ctx_switches_involuntary}")
+		if len(self.buffer.top_threads) > 0:
+			top_text = ", ".join([f"{name} ({tid}) {cpu_percent}%" for name, tid, cpu_percent in self.buffer.top_threads])
+			self.add_log(f"Top threads: {top_text}")
+		# Scheduler workers change names with their jobs, so cycles are counted by themselves
+		top_cycles = sorted(self.buffer.cycle_stats.items(), key=lambda item: -item[1]["cpu_time"])[:5]
+		if len(top_cycles) > 0:
+			top_text = ", ".join([f"{name} {round(stats['cpu_time'], 2)}s" for name, stats in top_cycles])
+			self.add_log(f"Top cycles by CPU: {top_text}")
 	#end define
 
 	def get_thread_name(self):
@@ -365,18 +2965,99 @@ class MyPyClass:
 		return result
 	#end define
 
-	def add_log(self, input_text, mode=INFO):
-		input_text = f"{input_text}"
-		time_text = date_time_library.datetime.utcnow().strftime("%d.%m.%Y, %H:%M:%S.%f")[:-3]
-		time_text = "{0} (UTC)".format(time_text).ljust(32, ' ')
+	def add_log(self, input_text, *args, mode=INFO, extra=None, rate_key=None, thread=None):
+		'''add_log("x=%s", x, mode=DEBUG); add_log(text, WARNING) is still accepted.
+		rate_key overrides the call site or template used by the rate limiter,
+		thread overrides the name of the current thread.'''
+		if len(args) == 1 and mode == INFO and type(args[0]) is str:
+			# Legacy add_log(text, mode) with any mode, unless the text has a placeholder for the argument
+			try:
+				input_text = input_text % args
+			except (TypeError, ValueError):
+				mode = args[0]
+			args = ()
+		#end if
 
-		# Pass if set log level
-		if self.db.config.logLevel != DEBUG and mode == DEBUG:
+		# In a process pool worker the line goes to the parent process
+		if process_log_queue is not None:
+			add_process_log(input_text, *args, mode=mode)
 			return
-		elif self.db.config.isIgnorLogWarning and mode == WARNING:
+
+		# Pass if set log level, before any formatting work.
+		# Item access avoids the slow Dict.__getattr__ fallback.
+		config = self.db["config"]
+		if mode == DEBUG:
+			if config.get("logLevel") != DEBUG:
+				return
+		elif mode == WARNING:
+			if config.get("isIgnorLogWarning"):
+				return
+		#end if
+
+		# Rate limiting by call site or by message template
+		now = time.time()
+		if config.get("isLogRateLimit"):
+			if rate_key is None:
+				if config.get("logRateKey") == "template":
+					# Any object can be logged, other than strings it may be unhashable
+					rate_key = input_text if type(input_text) is str else type(input_text)
+				else:
+					frame = sys._getframe(1)
+					rate_key = (frame.f_code.co_filename, frame.f_lineno)
+			if not self.log_rate_limiter.allow(rate_key, now):
+				return
+		#end if
+
+		# Lazy %-formatting
+		if args:
+			try:
+				input_text = input_text % args
+			except (TypeError, ValueError):
+				input_text = f"{input_text} {args}"
+		else:
+			input_text = f"{input_text}"
+		#end if
+
+		if thread is None:
+			thread = threading.current_thread().name
+		record = (mode, self.get_log_time_text(now), thread, input_text, now, extra)
+
+		# Queue for recording
+		if config.get("isWritingLogFile") or config.get("isWritingJsonLog"):
+			self.log_queue.append(record)
+
+		# Print log text
+		self.console_writer.write(record)
+	#end define
+
+	def report_suppressed_logs(self):
+		suppressed = self.log_rate_limiter.take_suppressed()
+		if len(suppressed) == 0:
 			return
+		items = list()
+		for key, count in sorted(suppressed.items(), key=lambda item: -item[1]):
+			if type(key) == tuple:
+				key = "{0}:{1}".format(*key)
+			else:
+				key = getattr(key, "__name__", key)
+			items.append(f"{key} x{count}")
+		self.add_log("Suppressed log messages: %s", ", ".join(items), mode=WARNING, rate_key="report_suppressed_logs")
+	#end define
+
+	def format_log_record(self, record, colored=False):
+		mode, time_text, thread_name, text, timestamp, extra = record
+		mode_text = self.log_mode_prefixes.get((mode, colored))
+		if mode_text is None:
+			mode_text = self.make_log_mode_prefix(mode, colored)
+		thread_text = self.log_thread_prefixes.get((thread_name, mode == ERROR, colored))
+		if thread_text is None:
+			thread_text = self.make_log_thread_prefix(thread_name, mode == ERROR, colored)
+		if colored is False and '\033' in text:
+			text = ANSI_ESCAPE_RE.sub('', text)
+		return mode_text + time_text + thread_text + text
+	#end define
 
-		# Set color mode
+	def make_log_mode_prefix(self, mode, colored):
 		if mode == INFO:
 			color_start = bcolors.INFO + bcolors.BOLD
 		elif mode == WARNING:
@@ -387,46 +3068,104 @@ class MyPyClass:
 			color_start = bcolors.DEBUG + bcolors.BOLD
 		else:
 			color_start = bcolors.UNDERLINE + bcolors.BOLD
-		mode_text = "{0}{1}{2}".format(color_start, "[{0}]".format(mode).ljust(10, ' '), bcolors.ENDC)
+		mode_text = "[{0}]".format(mode).ljust(10, ' ')
+		if colored:
+			mode_text = color_start + mode_text + bcolors.ENDC
+		self.log_mode_prefixes[(mode, colored)] = mode_text
+		return mode_text
+	#end define
 
-		# Set color thread
-		if mode == ERROR:
+	def make_log_thread_prefix(self, thread_name, is_error, colored):
+		if is_error:
 			color_start = bcolors.ERROR + bcolors.BOLD
 		else:
 			color_start = bcolors.OKGREEN + bcolors.BOLD
-		thread_text = "{0}{1}{2}".format(color_start, "<{0}>".format(self.get_thread_name()).ljust(14, ' '), bcolors.ENDC)
-		log_text = mode_text + time_text + thread_text + input_text
-
-		# Queue for recording
-		self.buffer.log_list.append(log_text)
+		thread_text = "<{0}>".format(thread_name).ljust(14, ' ')
+		if colored:
+			thread_text = color_start + thread_text + bcolors.ENDC
+		if len(self.log_thread_prefixes) > 1024:
+			self.log_thread_prefixes.clear()
+		self.log_thread_prefixes[(thread_name, is_error, colored)] = thread_text
+		return thread_text
+	#end define
 
-		# Print log text
-		print(log_text)
+	def get_log_time_text(self, now):
+		# The text is cached per millisecond, the date part per second
+		msec = int(now * 1000)
+		time_cache = self.log_time_cache
+		if time_cache[0] == msec:
+			return time_cache[1]
+		sec = msec // 1000
+		if time_cache[2] == sec:
+			date_text = time_cache[3]
+		else:
+			date_text = time.strftime("%d.%m.%Y, %H:%M:%S", time.gmtime(sec))
+		time_text = "{0}.{1:03d} (UTC)".format(date_text, msec % 1000).ljust(32, ' ')
+		self.log_time_cache = (msec, time_text, sec, date_text)
+		return time_text
 	#end define
 
 	def write_log(self):
-		log_file_name = self.buffer.log_file_name
+		# Write the whole batch with a single call, rotation is handled by log_rotator.
+		# The lock keeps batches in order when the flusher and shutdown write at once.
+		with self.log_write_lock:
+			log_list = self.log_queue.pop_batch()
+			if len(log_list) == 0:
+				return
+			if self.db.config.isWritingLogFile:
+				text = '\n'.join([self.format_log_record(record) for record in log_list]) + '\n'
+				self.log_rotator.write(text)
+			if self.db.config.isWritingJsonLog:
+				self.json_log_writer.write(log_list)
+	#end define
 
-		with open(log_file_name, 'a') as file:
-			while len(self.buffer.log_list) > 0:
-				log_text = self.buffer.log_list.pop(0)
-				file.write(log_text + '\n')
-			#end while
-		#end with
+	def run_log_flusher(self):
+		'''write_log when logFlushLines lines are queued or logFlushLatency seconds
+		after the first one, sleeps while the queue is empty'''
+		stats = self.get_cycle_stats("write_log")
+		self.log_queue.is_consumed = True
+		try:
+			while self.working:
+				self.log_queue.flush_lines = self.db.config.logFlushLines
+				self.log_queue.wait_batch(self.db.config.logFlushLatency)
+				if not self.working:
+					break  # shutdown() writes the log itself
+				self.run_flusher_step(self.write_log, stats)
+		finally:
+			self.log_queue.is_consumed = False
+	#end define
 
-		# Control log size
-		if self.db.config.isLimitLogFile is False:
-			return
-		allline = self.count_lines(log_file_name)
-		if allline > 4096 + 256:
-			delline = allline - 4096
-			f = open(log_file_name).readlines()
-			i = 0
-			while i < delline:
-				f.pop(0)
-				i = i + 1
-			with open(log_file_name, 'w') as F:
-				F.writelines(f)
+	def run_db_flusher(self):
+		'''save_db dbFlushLatency seconds after the first change of the db.
+		Without changes the file of the db is still checked for changes of other processes,
+		with an interval growing from dbFlushLatency to dbFlushMaxIdle.'''
+		stats = self.get_cycle_stats("save_db")
+		idle_time = self.db.config.dbFlushLatency
+		while self.working:
+			latency = self.db.config.dbFlushLatency
+			if self.db_tracker.wait_dirty(idle_time):
+				time.sleep(latency)  # changes made together go to one save
+				idle_time = latency
+			else:
+				idle_time = min(idle_time * 2, self.db.config.dbFlushMaxIdle)
+			if not self.working:
+				break  # shutdown() saves the db itself
+			self.run_flusher_step(self.save_db, stats)
+	#end define
+
+	def run_flusher_step(self, func, stats):
+		start = time.perf_counter()
+		cpu_start = time.thread_time()
+		self.try_function(func, stats=stats)
+		stats["runs"] += 1
+		stats["cpu_time"] += time.thread_time() - cpu_start
+		stats["latency"].add(time.perf_counter() - start)
+	#end define
+
+	def query_logs(self, since=None, until=None, level=None, thread=None):
+		'''Yield records of the JSON log, e.g. query_logs(since=get_timestamp()-300, level=ERROR)'''
+		self.json_log_writer.configure(bucket=self.db.config.logIndexBucket)
+		return self.json_log_writer.query(since, until, level, thread)
 	#end define
 
 	def count_lines(self, filename, chunk_size=1 << 13):
@@ -456,11 +3195,67 @@ class MyPyClass:
 	#end define
 
 	def exit(self, signum=None, frame=None):
+		'''Run shutdown() in its own thread and exit after it, or after shutdownTimeout
+		and a margin: as a signal handler this may interrupt a thread holding
+		the log, db or tracker locks which shutdown() takes'''
+		if self.is_shutdown_done:
+			sys.exit(0)  # e.g. after run_async(), nothing is left to flush
+		if self.shutdown_thread is not None or self.shutdown_lock.locked():
+			return  # a repeated signal while the shutdown is in progress
+		self.shutdown_thread = threading.Thread(target=self.shutdown, name="shutdown", daemon=True)
+		self.shutdown_thread.start()
+		self.shutdown_thread.join(self.get_shutdown_timeout() + 5)  # 5 seconds to flush the db and the log
+		sys.exit(0)
+	#end define
+
+	def get_shutdown_timeout(self):
+		# Plain dict reads, so that no lock is taken in a signal handler
+		config = dict.get(self.db, "config") or dict()
+		timeout = dict.get(config, "shutdownTimeout")
+		if timeout is None:
+			return 10
+		return timeout
+	#end define
+
+	def shutdown(self):
+		'''Stop new cycle runs, wait up to shutdownTimeout seconds for the running ones,
+		then flush the db and the log once. Returns False if already called.
+		Phase times are kept in buffer.shutdown_stats.'''
+		if not self.shutdown_lock.acquire(blocking=False):
+			return False
+		stats = Dict()
+		start = time.perf_counter()
+
+		# Stop
 		self.working = False
+		self.scheduler.stop()
 		if os.path.isfile(self.buffer.pid_file_path):
 			os.remove(self.buffer.pid_file_path)
-		self.save()
-		sys.exit(0)
+		phase_start = time.perf_counter()
+		stats.stop = phase_start - start
+
+		# Wait for running cycles
+		stats.is_drained = self.scheduler.wait_idle(self.db.config.shutdownTimeout)
+		if self.process_pool is not None:
+			self.process_pool.shutdown(wait=False, cancel_futures=True)
+		stats.drain = time.perf_counter() - phase_start
+		if stats.is_drained is False:
+			self.add_log("shutdown: cycles are still running after %s sec", self.db.config.shutdownTimeout, mode=WARNING)
+
+		# Flush the db, then the log with the report
+		phase_start = time.perf_counter()
+		self.try_function(self.save_db)
+		stats.db = time.perf_counter() - phase_start
+		self.add_log("Shutdown: stop %.3f sec, drain %.3f sec, db %.3f sec", stats.stop, stats.drain, stats.db, mode=DEBUG)
+		phase_start = time.perf_counter()
+		self.log_queue.is_consumed = False  # later lines are only kept up to logQueueSize
+		self.try_function(self.write_log)
+		self.console_writer.flush()
+		stats.log = time.perf_counter() - phase_start
+		stats.total = time.perf_counter() - start
+		self.buffer.shutdown_stats = stats
+		self.is_shutdown_done = True
+		return True
 	#end define
 
 	def read_file(self, path):
@@ -475,139 +3270,459 @@ class MyPyClass:
 	#end define
 
 	def read_db(self, db_path):
-		err = None
-		for i in range(10):
-			try:
-				return self.read_db_process(db_path)
-			except Exception as ex:
-				err = ex
-				time.sleep(0.1)
-		raise Exception(f"read_db error: {err}")
+		'''The result is cached until the file changes, treat it as read-only'''
+		file_stat = self.get_file_stat(db_path)
+		cache = self.db_read_cache.get(db_path)
+		if file_stat is not None and cache is not None and cache[0] == file_stat:
+			self.buffer.db_stats["cache_hits"] += 1
+			return cache[1]
+
+		# Writers replace the file atomically, a shared lock is enough to read it whole
+		self.lock_file(db_path, shared=True)
+		try:
+			file_stat = self.get_file_stat(db_path)
+			data = self.read_db_process(db_path)
+		except Exception as err:
+			raise Exception(f"read_db error: {err}")
+		finally:
+			self.unlock_file(db_path)
+		self.db_read_cache[db_path] = (file_stat, data)
+		self.buffer.db_stats["reads"] += 1
+		return data
 	#end define
 
 	def read_db_process(self, db_path):
-		text = self.read_file(db_path)
-		data = json.loads(text)
-		return Dict(data)
+		with open(db_path, 'rb') as file:
+			data = file.read()
+		serializer = self.get_db_serializer_by_data(data)
+		if serializer.binary:
+			data = memoryview(data)[data.find(b'\n') + 1:]
+		return LazyDict(serializer.loads(data))
+	#end define
+
+	def add_db_serializer(self, serializer):
+		self.db_serializers[serializer.name] = serializer
+	#end define
+
+	def get_db_serializer(self, name=None):
+		if name is None:
+			name = self.db.config.dbFormat or "json"
+		serializer = self.db_serializers.get(name)
+		if serializer is None:
+			raise Exception(f"get_db_serializer error: unknown db format `{name}`")
+		return serializer
+	#end define
+
+	def get_db_serializer_by_data(self, data):
+		if not data.startswith(b"MPDB:"):
+			return self.get_db_serializer("json")
+		name = data[5:data.find(b'\n')].decode("utf-8")
+		return self.get_db_serializer(name)
+	#end define
+
+	def serialize_db(self, data, name=None):
+		serializer = self.get_db_serializer(name)
+		if serializer.binary:
+			return serializer.get_header() + serializer.dumps(data)
+		return serializer.dumps(data)
 	#end define
 
 	def write_db(self, data):
 		db_path = self.buffer.db_path
-		text = json.dumps(data, indent=4)
+		text = self.serialize_db(data)
 		self.lock_file(db_path)
-		self.write_file(db_path, text)
-		self.unlock_file(db_path)
+		try:
+			self.write_file_atomic(db_path, text)
+		finally:
+			self.unlock_file(db_path)
 	#end define
 
-	def lock_file(self, path):
-		pid_path = path + ".lock"
-		for i in range(300):
-			if os.path.isfile(pid_path):
-				time.sleep(0.01)
-			else:
-				self.write_file(pid_path)
-				return
-		raise Exception("lock_file error: time out.")
+	def write_file_atomic(self, path, text):
+		# Readers see either the old or the new file, never a partial one
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		try:
+			old_stat = os.stat(path)
+		except FileNotFoundError:
+			old_stat = None
+		with open(tmp_path, 'wb' if type(text) is bytes else 'wt') as file:
+			# Keep the permissions and the owner of the replaced file, e.g. 0600 of a db with secrets
+			if old_stat is not None:
+				os.fchmod(file.fileno(), old_stat.st_mode & 0o7777)
+				if os.getuid() == 0:
+					os.fchown(file.fileno(), old_stat.st_uid, old_stat.st_gid)
+			file.write(text)
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(tmp_path, path)
+		dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+		try:
+			os.fsync(dir_fd)
+		finally:
+			os.close(dir_fd)
+	#end define
+
+	def get_file_lock(self, path):
+		file_lock = self.file_locks.get(path)
+		if file_lock is None:
+			file_lock = self.file_locks.setdefault(path, FileLock(path))
+		return file_lock
+	#end define
+
+	def lock_file(self, path, shared=False):
+		self.get_file_lock(path).acquire(shared)
 	#end define
 
 	def unlock_file(self, path):
-		pid_path = path + ".lock"
-		try:
-			os.remove(pid_path)
-		except:
-			print("Wow. You are faster than me")
+		self.get_file_lock(path).release()
 	#end define
 	
-	def merge_three_dicts(self, local_data, file_data, old_file_data):
+	def merge_three_dicts(self, local_data, file_data, old_file_data, dirty_paths=None):
+		'''Apply changes of file_data (relative to old_file_data) to local_data.
+		old_file_data is a dict or a DictSnapshot of local_data.
+		dirty_paths are the paths changed in local_data since old_file_data,
+		subtrees outside of them are known to be locally unchanged and are not compared.
+		Without dirty_paths every subtree is compared.
+		Returns Dict with `local_changes`, `file_changes` and `conflicts` lists of paths.
+		On a conflict the file value wins.'''
 		if (id(local_data) == id(file_data) or
 			id(file_data) == id(old_file_data) or
 			id(local_data) == id(old_file_data)):
-			print(local_data.keys())
-			print(file_data.keys())
 			raise Exception(f"merge_three_dicts error: merge the same object")
 		#end if
-		
-		need_write_local_data = False
-		if local_data == file_data and file_data == old_file_data:
-			return need_write_local_data
+
+		result = Dict()
+		result.local_changes = list()
+		result.file_changes = list()
+		result.conflicts = list()
+		is_tracked = isinstance(local_data, TrackedDict)
+		if isinstance(old_file_data, DictSnapshot):
+			if not old_file_data.is_valid():
+				raise Exception(f"merge_three_dicts error: outdated snapshot")
+			snapshot = old_file_data
+			old_file_data = snapshot.resolve(snapshot.root)
+			resolve = snapshot.resolve
+			materialize = snapshot.materialize
+		else:
+			resolve = materialize = lambda value: value
 		#end if
 
-		dict_keys = list()
-		dict_keys += [key for key in local_data if key not in dict_keys]
-		dict_keys += [key for key in file_data if key not in dict_keys]
-		for key in dict_keys:
-			buff = self.merge_three_dicts_process(key, local_data, file_data, old_file_data)
-			if buff is True:
+		# Iterative walk, a stack item is (path, local, file, old, dirty)
+		# where dirty is None (clean), True (unknown) or a tree of dirty keys.
+		# A clean local subtree is identical to the old one, so snapshot nodes
+		# only have to be resolved along dirty paths.
+		stack = [((), local_data, file_data, old_file_data, self.get_dirty_tree(dirty_paths))]
+		while len(stack) > 0:
+			path, local, file, old, dirty = stack.pop()
+			keys = list(local)
+			keys += [key for key in file if key not in local]
+			for key in keys:
+				local_item = local.get(key, MISSING)
+				file_item = file.get(key, MISSING)
+				old_item = old.get(key, MISSING)
+				if dirty is None:
+					item_dirty = None
+				elif dirty is True:
+					item_dirty = True
+				else:
+					item_dirty = dirty.get(key)
+				if item_dirty is None:
+					is_local_changed = False
+					is_file_changed = file_item is not old_item and file_item != old_item
+				elif item_dirty is not True and isinstance(local_item, dict) and isinstance(file_item, dict) and isinstance(old_item, dict):
+					# Only some keys below are dirty, compare them one by one
+					stack.append((path + (key,), local_item, file_item, resolve(old_item), item_dirty))
+					continue
+				else:
+					old_value = materialize(old_item)
+					is_local_changed = local_item != old_value
+					is_file_changed = file_item is not old_value and file_item != old_value
+				#end if
+				if is_file_changed is False:
+					if is_local_changed:
+						result.local_changes.append(path + (key,))
+					continue
+				if is_local_changed and local_item == file_item:
+					continue
+				if isinstance(local_item, dict) and isinstance(file_item, dict) and isinstance(old_item, dict):
+					stack.append((path + (key,), local_item, file_item, resolve(old_item), item_dirty))
+					continue
+				if is_local_changed:
+					result.conflicts.append(path + (key,))
+				else:
+					result.file_changes.append(path + (key,))
+				if file_item is MISSING:
+					local.pop(key, None)
+				elif is_tracked:
+					local[key] = file_item  # TrackedDict copies containers itself
+				else:
+					local[key] = copy_value(file_item)
+			#end for
+		#end while
+		return result
+	#end define
+
+	def get_dirty_tree(self, dirty_paths):
+		'''{"a": {"b": True}} for ("a", "b"); True means the whole subtree is unknown'''
+		if dirty_paths is None or () in dirty_paths:
+			return True
+		tree = dict()
+		for path in sorted(dirty_paths, key=len):
+			node = tree
+			for key in path[:-1]:
+				node = node.setdefault(key, dict())
+				if node is True:
+					break
+			if node is not True:
+				node[path[-1]] = True
+		return tree
+	#end define
+
+	def save_db(self):
+		with self.db_save_lock:
+			start = time.perf_counter()
+			try:
+				self.save_db_process()
+			finally:
+				self.buffer.db_save_latency.add(time.perf_counter() - start)
+	#end define
+
+	def save_db_process(self):
+		if self.shared_db is not None and self.shared_db.is_owner is False:
+			return  # the owner process saves the db
+		db_path = self.buffer.db_path
+		is_tracked = self.is_db_tracked()
+		if is_tracked and self.db.config.isDbJournal is True:
+			self.save_db_journal()
+			return
+		if self.buffer.db_journal_size > 0:
+			# Journal mode was switched off, fold the journal into the snapshot first
+			self.compact_db_journal()
+		is_file_changed = self.get_file_stat(db_path) != self.buffer.db_file_stat
+
+		# Nothing to do if neither the local db nor the file have changed
+		if is_tracked and not is_file_changed and not self.db_tracker.is_dirty():
+			return
+
+		# Read, merge and write under one exclusive lock, so that processes
+		# sharing the db do not lose each other's updates
+		self.lock_file(db_path)
+		try:
+			is_file_changed = self.get_file_stat(db_path) != self.buffer.db_file_stat
+			dirty_paths = self.db_tracker.take() if is_tracked else None
+			if is_tracked and not is_file_changed:
+				need_write_local_data = True
+			else:
+				file_data = self.read_db(db_path)
+				# Values the merge takes from the file are already saved, they do not make the db dirty
+				self.db_tracker.quiet_ident = threading.get_ident()
+				try:
+					merge_result = self.merge_three_dicts(self.db, file_data, self.old_db, dirty_paths)
+				finally:
+					self.db_tracker.quiet_ident = None
+				need_write_local_data = len(merge_result.local_changes) > 0
+				if len(merge_result.conflicts) > 0:
+					self.buffer.db_stats["conflicts"] += len(merge_result.conflicts)
+					self.add_log("save_db: file wins on conflicting paths %s", merge_result.conflicts, mode=DEBUG)
+			self.take_db_snapshot()
+			if is_tracked and self.db_tracker.is_dirty():
+				# Changed by other threads since take(): the snapshot has these changes,
+				# so the file must have them too. They stay dirty for the next save_db.
 				need_write_local_data = True
-		return need_write_local_data
+			if need_write_local_data is True:
+				self.write_db(self.db)
+			self.buffer.db_file_stat = self.get_file_stat(db_path)
+			self.buffer.db_generation = self.db_tracker.generation
+		finally:
+			self.unlock_file(db_path)
 	#end define
 
-	def merge_three_dicts_process(self, key, local_data, file_data, old_file_data):
-		need_write_local_data = False
-		tmp = self.mtdp_get_tmp(key, local_data, file_data, old_file_data)
-		if tmp.local_item != tmp.file_item and tmp.file_item == tmp.old_file_item:
-			# find local change
-			self.mtdp_flc(key, local_data, file_data, old_file_data)
-			need_write_local_data = True
-		elif tmp.file_item != tmp.old_file_item:
-			# find config file change
-			self.mtdp_fcfc(key, local_data, file_data, old_file_data)
-		return need_write_local_data
+	def save_db_journal(self):
+		'''Append the changed subtrees to the journal instead of rewriting the whole db.
+		Journal mode assumes that this process is the only writer of the db.'''
+		if not self.db_tracker.is_dirty():
+			return
+		dirty_paths = self.db_tracker.take()
+		records = self.get_journal_records(dirty_paths)
+		text = ''.join([json.dumps(record, separators=(',', ':')) + '\n' for record in records])
+		journal_path = self.buffer.db_journal_path
+		self.lock_file(self.buffer.db_path)
+		try:
+			with open(journal_path, 'at') as file:
+				file.write(text)
+				file.flush()
+				os.fsync(file.fileno())
+		finally:
+			self.unlock_file(self.buffer.db_path)
+		self.buffer.db_journal_size += len(text)
+		self.buffer.db_stats["journal_records"] += len(records)
+		self.buffer.db_generation = self.db_tracker.generation
+
+		if self.buffer.db_journal_size > self.db.config.dbJournalMaxSize and self.db_compacting is False:
+			self.db_compacting = True
+			self.start_thread(self.compact_db_journal, name="compact_db_journal")
 	#end define
-	
-	def mtdp_get_tmp(self, key, local_data, file_data, old_file_data):
-		tmp = Dict()
-		tmp.local_item = local_data.get(key)
-		tmp.file_item = file_data.get(key)
-		tmp.old_file_item = old_file_data.get(key)
-		tmp.local_item_type = type(tmp.local_item)
-		tmp.file_item_type = type(tmp.file_item)
-		tmp.old_file_item_type = type(tmp.old_file_item)
-		return tmp
-	#end define
-
-	def mtdp_flc(self, key, local_data, file_data, old_file_data):
-		dict_types = [dict, Dict]
-		tmp = self.mtdp_get_tmp(key, local_data, file_data, old_file_data)
-		if tmp.local_item_type in dict_types and tmp.file_item_type in dict_types and tmp.old_file_item_type in dict_types:
-			self.merge_three_dicts(tmp.local_item, tmp.file_item, tmp.old_file_item)
-		elif tmp.local_item is None:
-			#print(f"find local change {key} -> {tmp.local_item}")
-			pass
-		elif tmp.local_item_type not in dict_types:
-			#print(f"find local change {key}: {tmp.old_file_item} -> {tmp.local_item}")
-			pass
-		elif tmp.local_item_type in dict_types:
-			#print(f"find local change {key}: {tmp.old_file_item} -> {tmp.local_item}")
-			pass
+
+	def get_journal_records(self, dirty_paths):
+		# A changed subtree covers every change below it
+		result = list()
+		written = set()
+		for path in sorted(dirty_paths, key=len):
+			if any(path[:i] in written for i in range(len(path))):
+				continue
+			written.add(path)
+			node = self.db
+			for key in path[:-1]:
+				node = node.get(key) if isinstance(node, dict) else None
+			if len(path) == 0:
+				result.append({"op": "set", "p": [], "v": self.db})
+			elif isinstance(node, dict) and path[-1] in node:
+				result.append({"op": "set", "p": list(path), "v": node[path[-1]]})
+			else:
+				result.append({"op": "del", "p": list(path)})
+		return result
+	#end define
+
+	def compact_db_journal(self):
+		with self.db_save_lock:
+			self.lock_file(self.buffer.db_path)
+			try:
+				self.write_db(self.db)
+				with open(self.buffer.db_journal_path, 'w'):
+					pass
+				self.buffer.db_journal_size = 0
+				self.buffer.db_file_stat = self.get_file_stat(self.buffer.db_path)
+				self.take_db_snapshot()
+				self.buffer.db_stats["compactions"] += 1
+			finally:
+				self.unlock_file(self.buffer.db_path)
+				self.db_compacting = False
+	#end define
+
+	def replay_db_journal(self, data, journal_path):
+		if not os.path.isfile(journal_path):
+			return 0
+		with open(journal_path, 'rt') as file:
+			for line in file:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					break  # a torn last record after a crash
+				self.apply_journal_record(data, record)
+		return os.path.getsize(journal_path)
+	#end define
+
+	def apply_journal_record(self, data, record):
+		path = record["p"]
+		if len(path) == 0:
+			data.clear()
+			data.update(Dict(record["v"]))
+			return
+		node = data
+		for key in path[:-1]:
+			if not isinstance(node.get(key), dict):
+				node[key] = Dict()
+			node = node[key]
+		if record["op"] == "set":
+			value = record["v"]
+			node[path[-1]] = Dict(value) if isinstance(value, dict) else value
 		else:
-			raise Exception(f"mtdp_flc error: {key} -> {tmp.local_item_type}, {tmp.file_item_type}, {tmp.old_file_item_type}")
-	#end define
-
-	def mtdp_fcfc(self, key, local_data, file_data, old_file_data):
-		dict_types = [dict, Dict]
-		tmp = self.mtdp_get_tmp(key, local_data, file_data, old_file_data)
-		if tmp.local_item_type in dict_types and tmp.file_item_type in dict_types and tmp.old_file_item_type in dict_types:
-			self.merge_three_dicts(tmp.local_item, tmp.file_item, tmp.old_file_item)
-		elif tmp.file_item is None:
-			#print(f"find config file change {key} -> {tmp.file_item}")
-			local_data.pop(key)
-		elif tmp.file_item_type not in dict_types:
-			#print(f"find config file change {key}: {tmp.old_file_item} -> {tmp.file_item}")
-			local_data[key] = tmp.file_item
-		elif tmp.file_item_type in dict_types:
-			#print(f"find config file change {key}: {tmp.old_file_item} -> {tmp.file_item}")
-			local_data[key] = Dict(tmp.file_item)
+			node.pop(path[-1], None)
+	#end define
+
+	def take_db_snapshot(self):
+		'''Remember the current db as the old side of the next merge'''
+		if self.is_db_tracked():
+			self.old_db = self.db_tracker.snapshot(self.db)
 		else:
-			raise Exception(f"mtdp_fcfc error: {key} -> {tmp.local_item_type}, {tmp.file_item_type}, {tmp.old_file_item_type}")
+			self.old_db = Dict(self.db)
 	#end define
 
-	def save_db(self):
-		file_data = self.read_db(self.buffer.db_path)
-		need_write_local_data = self.merge_three_dicts(self.db, file_data, self.buffer.old_db)
-		self.buffer.old_db = Dict(self.db)
-		if need_write_local_data is True:
-			self.write_db(self.db)
+	def track_db(self):
+		'''Replace the db with a TrackedDict for the db flusher, the journal and the shared db.
+		Without them the db stays a Dict, tracking would only slow down every access.'''
+		with self.db_save_lock:
+			if self.is_db_tracked():
+				return
+			is_changed = self.db != self.old_db
+			self.db_tracker.take()
+			self.db = TrackedDict(self.db, self.db_tracker, lazy=True)
+			if is_changed:
+				self.db_tracker.mark(())  # not saved yet, the next save_db compares the whole db
+	#end define
+
+	def is_db_tracked(self):
+		return isinstance(self.db, TrackedDict) and self.db._tracker is self.db_tracker
+	#end define
+
+	def get_file_stat(self, path):
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			return None
+		return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+	#end define
+
+	def start_db_watcher(self):
+		if self.db_watcher is not None:
+			return
+		self.db_watcher = InotifyWatcher(self.buffer.db_path, self.on_db_file_event)
+		if self.db_watcher.start() is False:
+			self.db_watcher = None
+			self.add_log("start_db_watcher: inotify is not available", mode=WARNING)
+	#end define
+
+	def on_db_file_event(self):
+		self.buffer.db_stats["watch_events"] += 1
+		self.try_function(self.save_db)
+	#end define
+
+	def start_shared_db(self, mode):
+		'''The owner publishes the db to buffer.shared_db_path on every change,
+		readers replace their db with the published one when its version changes'''
+		self.track_db()
+		shared_db = SharedDbView(self.buffer.shared_db_path)
+		try:
+			if mode == "owner":
+				shared_db.open_owner()
+			else:
+				shared_db.open_reader()
+		except Exception as err:
+			self.add_log(f"start_shared_db error: {err}", mode=ERROR)
+			return
+		self.shared_db = shared_db
+		self.buffer.shared_db_stats = shared_db.stats
+		self.sync_shared_db()
+		self.start_cycle(self.sync_shared_db, sec=self.db.config.dbSharedInterval)
+	#end define
+
+	def sync_shared_db(self):
+		shared_db = self.shared_db
+		if shared_db.is_owner:
+			generation = self.db_tracker.generation
+			if generation != shared_db.generation or not self.is_db_tracked():
+				shared_db.publish(self.get_db_serializer("marshal").dumps(self.db))
+				shared_db.generation = generation
+			return
+		if shared_db.get_sequence() == shared_db.version:
+			return
+		version, data = shared_db.read()
+		if version is None:
+			return
+		with self.db_save_lock:
+			mode = self.db.config.dbSharedMode
+			self.db = TrackedDict(self.get_db_serializer("marshal").loads(data), self.db_tracker, lazy=True)
+			self.take_db_snapshot()
+			self.set_default_config()
+			self.db.config.dbSharedMode = mode
+			self.db_tracker.take()
+		shared_db.version = version
+	#end define
+
+	def mark_dirty(self):
+		'''Force the next save_db to write, for changes made around the tracked containers.
+		Also wakes up the db and log flushers.'''
+		self.db_tracker.mark(())
+		self.log_queue.request_flush()
 	#end define
 	
 	def save(self):
@@ -620,15 +3735,35 @@ class MyPyClass:
 		if not db_path:
 			db_path = self.buffer.db_path
 		if not os.path.isfile(db_path):
-			self.write_db(self.db)
+			# Several processes may start at once, only the first creates the file
+			self.lock_file(db_path)
+			try:
+				if not os.path.isfile(db_path):
+					self.write_db(self.db)
+			finally:
+				self.unlock_file(db_path)
+		#end if
 		try:
 			file_data = self.read_db(db_path)
-			self.db = Dict(file_data)
-			self.buffer.old_db = Dict(file_data)
+			journal_path = db_path + ".journal"
+			if os.path.isfile(journal_path):
+				file_data = Dict(file_data)
+				journal_size = self.replay_db_journal(file_data, journal_path)
+				if db_path == self.buffer.db_path:
+					self.buffer.db_journal_size = journal_size
+			if self.is_db_tracked():
+				self.db_tracker.take()  # changes of the replaced db are dropped with it
+				# Nested dicts are wrapped on first access, file_data stays a valid cache entry
+				self.db = TrackedDict(file_data, self.db_tracker, lazy=True)
+			else:
+				self.db = Dict(file_data)
+			self.take_db_snapshot()
+			if db_path == self.buffer.db_path:
+				self.buffer.db_file_stat = self.db_read_cache[db_path][0]
 			self.set_default_config()
 			result = True
 		except Exception as err:
-			self.add_log(f"load_db error: {err}", ERROR)
+			self.add_log(f"load_db error: {err}", mode=ERROR)
 		return result
 	#end define
 
@@ -642,7 +3777,7 @@ class MyPyClass:
 			print("get setting successful: " + file_path)
 			self.exit()
 		except Exception as err:
-			self.add_log(f"get_settings error: {err}", WARNING)
+			self.add_log(f"get_settings error: {err}", mode=WARNING)
 	#end define
 
 	def get_python3_path(self):
@@ -673,6 +3808,8 @@ class MyPyClass:
 	#end define
 
 	def try_function(self, func, **kwargs):
+		'''stats: cycle stats Dict, its `errors` counter is incremented on an exception,
+		name: function name for the error log'''
 		args = kwargs.get("args")
 		result = None
 		try:
@@ -681,7 +3818,10 @@ class MyPyClass:
 			else:
 				result = func(*args)
 		except Exception as err:
-			self.add_log(f"{func.__name__} error: {err}", ERROR)
+			stats = kwargs.get("stats")
+			if stats is not None:
+				stats["errors"] += 1
+			self.add_log("%s error: %s", kwargs.get("name", func.__name__), err, mode=ERROR, rate_key=func)
 		return result
 	#end define
 
@@ -692,20 +3832,206 @@ class MyPyClass:
 			threading.Thread(target=func, name=name, daemon=True).start()
 		else:
 			threading.Thread(target=func, name=name, args=args, daemon=True).start()
-		self.add_log("Thread {name} started".format(name=name), "debug")
+		self.add_log("Thread %s started", name, mode=DEBUG)
+	#end define
+
+	def start_cycle(self, func, **kwargs):
+		'''Run func every `sec` seconds on the scheduler and return its ScheduledJob.
+		Optional kwargs: timing (FIXED_RATE || FIXED_DELAY), jitter (seconds),
+		overrun (SKIP || QUEUE || CONCURRENT), delay before the first run,
+		executor="process" to run a picklable func in the process pool (see submit).
+		Coroutine functions run on the event loop instead, see start_async_cycle.'''
+		name = kwargs.get("name", func.__name__)
+		args = kwargs.get("args")
+		sec = kwargs.get("sec")
+		if asyncio.iscoroutinefunction(func):
+			return self.start_async_cycle(func, **kwargs)
+		stats = self.get_cycle_stats(name)
+		if kwargs.get("executor") == "process":
+			target = lambda: self.try_function(self.run_in_process, args=(func, args, name), stats=stats, name=func.__name__)
+		else:
+			target = lambda: self.try_function(func, args=args, stats=stats)
+		job = self.scheduler.schedule(
+			target, name, interval=sec,
+			delay=kwargs.get("delay", 0),
+			timing=kwargs.get("timing", FIXED_RATE),
+			jitter=kwargs.get("jitter", 0),
+			overrun=kwargs.get("overrun", SKIP),
+			stats=stats)
+		self.add_log("Cycle %s started", name, mode=DEBUG)
+		return job
+	#end define
+
+	def get_process_pool(self):
+		with self.process_pool_lock:
+			if self.process_pool is None:
+				# Workers must not fork a copy of this process with its threads and held locks
+				context = multiprocessing.get_context("forkserver")
+				log_queue = context.Queue()
+				self.process_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=context,
+					initializer=init_process_worker, initargs=(log_queue,))
+				self.start_thread(self.process_log_listener, args=(log_queue,))
+		return self.process_pool
+	#end define
+
+	def process_log_listener(self, log_queue):
+		while True:
+			mode, thread, text = log_queue.get()
+			self.add_log(text, mode=mode, thread=thread)
+	#end define
+
+	def submit(self, func, *args, name=None):
+		'''Run a picklable function in the process pool and return its Future.
+		Errors are logged like try_function does, workers log with add_process_log().'''
+		if name is None:
+			name = func.__name__
+		future = self.get_process_pool().submit(run_process_job, func, name, args or None)
+		future.add_done_callback(lambda future: self.report_process_error(future, func, name))
+		return future
+	#end define
+
+	def report_process_error(self, future, func, name):
+		if future.cancelled():
+			return
+		err = future.exception()
+		if err is not None:
+			self.add_log("%s error: %s", func.__name__, err, mode=ERROR, rate_key=func, thread=name)
+	#end define
+
+	def run_in_process(self, func, args, name):
+		# Wait for the result, so that the scheduler overrun policy applies to the job.
+		# The error is raised again for try_function to count and log it.
+		future = self.get_process_pool().submit(run_process_job, func, name, args)
+		err = future.exception()
+		if err is not None:
+			raise err
+	#end define
+
+	def get_cycle_stats(self, name):
+		stats = self.buffer.cycle_stats.get(name)
+		if stats is None:
+			stats = make_cycle_stats()
+			self.buffer.cycle_stats[name] = stats
+		return stats
+	#end define
+
+	def start_async_cycle(self, func, **kwargs):
+		'''Run the coroutine function every `sec` seconds as a task of the running loop,
+		or of the run_async() loop when called from another thread.
+		Returns the task (or a concurrent Future), cancel() stops the cycle.'''
+		name = kwargs.get("name", func.__name__)
+		coroutine = self.async_cycle(func, kwargs.get("sec"), kwargs.get("args"), name,
+			kwargs.get("delay", 0), kwargs.get("timing", FIXED_RATE), kwargs.get("jitter", 0))
+		try:
+			loop = asyncio.get_running_loop()
+		except RuntimeError:
+			loop = None
+		if loop is not None:
+			return loop.create_task(coroutine, name=name)
+		if self.loop is not None:
+			return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+		coroutine.close()
+		raise Exception(f"start_async_cycle error: no event loop for `{name}`, use run_async()")
 	#end define
 
-	def cycle(self, func, sec, args):
+	async def async_cycle(self, func, sec, args, name, delay=0, timing=FIXED_RATE, jitter=0):
+		loop = asyncio.get_running_loop()
+		stats = self.get_cycle_stats(name)
+		if delay:
+			await asyncio.sleep(delay)
+		next_time = loop.time()
 		while self.working:
-			self.try_function(func, args=args)
-			time.sleep(sec)
+			start = loop.time()
+			await self.async_try_function(func, args=args, name=name, stats=stats)
+			now = loop.time()
+			stats["runs"] += 1
+			stats["latency"].add(now - start)
+			if sec is None:
+				return
+			if now - start > sec:
+				stats["overruns"] += 1
+			if timing == FIXED_DELAY:
+				next_time = now + sec
+			else:
+				next_time += sec
+				if next_time <= now:
+					next_time += ((now - next_time) // sec + 1) * sec
+			await asyncio.sleep(next_time - now + (random.uniform(0, jitter) if jitter else 0))
 	#end define
 
-	def start_cycle(self, func, **kwargs):
+	async def async_try_function(self, func, **kwargs):
+		args = kwargs.get("args")
+		result = None
+		try:
+			if args is None:
+				result = await func()
+			else:
+				result = await func(*args)
+		except Exception as err:
+			stats = kwargs.get("stats")
+			if stats is not None:
+				stats["errors"] += 1
+			self.add_log("%s error: %s", func.__name__, err, mode=ERROR, rate_key=func, thread=kwargs.get("name"))
+		return result
+	#end define
+
+	async def async_add_log(self, input_text, *args, **kwargs):
+		'''add_log that never blocks the event loop: a full queue with the BLOCK policy
+		is awaited instead, printing is left to the console writer thread'''
+		if kwargs.get("rate_key") is None:
+			frame = sys._getframe(1)
+			kwargs["rate_key"] = (frame.f_code.co_filename, frame.f_lineno)
+		if "thread" not in kwargs:
+			task = asyncio.current_task()
+			kwargs["thread"] = task.get_name() if task is not None else None
+		self.console_writer.start()
+		for queue in [self.log_queue, self.console_writer.queue]:
+			while queue.overflow == BLOCK and queue.is_consumed and not queue.has_space():
+				await asyncio.sleep(0.01)
+		self.add_log(input_text, *args, **kwargs)
+	#end define
+
+	async def async_save_db(self):
+		await asyncio.get_running_loop().run_in_executor(None, self.save_db)
+	#end define
+
+	async def async_load_db(self, db_path=False):
+		return await asyncio.get_running_loop().run_in_executor(None, self.load_db, db_path)
+	#end define
+
+	def run_async(self, main):
+		'''Run the coroutine (function) main in a new event loop.
+		SIGINT/SIGTERM cancel main, then shutdown() saves the db and the log as in exit().'''
+		return asyncio.run(self.run_async_main(main))
+	#end define
+
+	async def run_async_main(self, main):
+		self.loop = asyncio.get_running_loop()
+		self.console_writer.start()
+		task = asyncio.current_task()
+		signals = [signal.SIGINT, signal.SIGTERM]
+		for signum in signals:
+			self.loop.add_signal_handler(signum, task.cancel)
+		try:
+			if callable(main):
+				main = main()
+			return await main
+		except asyncio.CancelledError:
+			self.add_log("run_async: stopped by signal", mode=DEBUG)
+		finally:
+			for signum in signals:
+				self.loop.remove_signal_handler(signum)
+				signal.signal(signum, self.exit)
+			await self.loop.run_in_executor(None, self.shutdown)
+			self.loop = None
+	#end define
+
+	def start_timer(self, func, **kwargs):
+		'''Run func once after `sec` seconds on the scheduler and return its ScheduledJob'''
 		name = kwargs.get("name", func.__name__)
 		args = kwargs.get("args")
-		sec = kwargs.get("sec")
-		self.start_thread(self.cycle, name=name, args=(func, sec, args))
+		sec = kwargs.get("sec", 0)
+		return self.scheduler.schedule(lambda: self.try_function(func, args=args), name, delay=sec)
 	#end define
 
 	def init_translator(self, file_path=None):
@@ -731,6 +4057,32 @@ class MyPyClass:
 	#end define
 #end class
 
+def get_metric_labels(**labels):
+	items = list()
+	for key, value in labels.items():
+		value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		items.append(f'{key}="{value}"')
+	return '{' + ','.join(items) + '}'
+#end define
+
+def get_histogram_lines(name, histogram, **labels):
+	# Octave bounds only, the sub buckets of an octave are summed up
+	result = list()
+	total = 0
+	buckets = histogram["buckets"]
+	for index, count in enumerate(buckets):
+		total += count
+		is_last = index == len(buckets) - 1
+		if is_last or (index + 1) % LatencyHistogram.sub_buckets == 0:
+			upper = LatencyHistogram.get_upper_bound(index)
+			le = "+Inf" if upper == math.inf else repr(upper)
+			result.append(f"{name}_bucket{get_metric_labels(**labels, le=le)} {total}")
+	label_text = get_metric_labels(**labels) if labels else ""
+	result.append(f"{name}_sum{label_text} {histogram['sum']}")
+	result.append(f"{name}_count{label_text} {histogram['count']}")
+	return result
+#end define
+
 def get_hash_md5(file_name):
 	blocksize = 65536
 	hasher = hashlib.md5()